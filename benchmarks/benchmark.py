@@ -0,0 +1,259 @@
+import sys
+import time
+import json
+import logging
+import platform
+import argparse
+import threading
+
+from digimat.espa import Server, Client, MultiChannelServer, LinkLoopback
+from digimat.espa.espa import CommunicationChannel, MessageServer
+from digimat.espa.frame import encode_frame, decode_frame
+
+# ESPA protocol stack benchmarks
+#
+#   python benchmarks/benchmark.py --output results.json
+#   python benchmarks/benchmark.py --save-baseline baseline.json
+#   python benchmarks/benchmark.py --baseline baseline.json --tolerance 0.2
+#
+# Results are written as JSON. When a baseline is given, every result is
+# compared with it and the exit code is 1 if any of them regressed by more
+# than the tolerance.
+
+LOGLEVEL=logging.CRITICAL
+
+SHORT_MESSAGE={'1': '1234', '2': 'Room 12 call'}
+LONG_MESSAGE={'1': '12345678', '2': 'X'*120, '3': '1', '4': '2', '6': '3'}
+
+
+def uniqueName(prefix):
+    # logger names are shared by process, keep them unique per run
+    uniqueName.count+=1
+    return '%s-%d' % (prefix, uniqueName.count)
+
+
+uniqueName.count=0
+
+
+def percentile(values, p):
+    values=sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values)-1, int(len(values)*p))]
+
+
+def timeit(func, count):
+    t0=time.perf_counter()
+    for n in range(count):
+        func()
+    return time.perf_counter()-t0
+
+
+class Results(object):
+    def __init__(self):
+        self._results={}
+
+    def add(self, name, value, unit, better):
+        self._results[name]={'value': value, 'unit': unit, 'better': better}
+        print('%-48s %14.3f %s' % (name, value, unit))
+
+    def asDict(self):
+        return {'meta': {'python': platform.python_version(),
+                         'implementation': platform.python_implementation(),
+                         'machine': platform.machine(),
+                         'timestamp': time.time()},
+                'results': self._results}
+
+    def compare(self, baseline, tolerance):
+        regressions=[]
+        for (name, result) in self._results.items():
+            try:
+                reference=baseline['results'][name]['value']
+            except KeyError:
+                continue
+            if not reference:
+                continue
+            ratio=result['value']/reference
+            if result['better']=='higher':
+                regression=ratio<1.0-tolerance
+            else:
+                regression=ratio>1.0+tolerance
+            print('%-48s %8.2fx %s' % (name, ratio, 'REGRESSION' if regression else 'ok'))
+            if regression:
+                regressions.append(name)
+        return regressions
+
+
+def channel():
+    (link, peer)=LinkLoopback.pair(uniqueName('bench'), uniqueName('peer'))
+    logger=logging.getLogger(uniqueName('ESPA-BENCH'))
+    logger.setLevel(LOGLEVEL)
+    return (CommunicationChannel(link, logger), peer)
+
+
+def benchDecode(results, count):
+    (c, peer)=channel()
+    server=MessageServer(c, c.logger)
+    for (name, data) in (('short', SHORT_MESSAGE), ('long', LONG_MESSAGE)):
+        frame=encode_frame('1', data)
+        block=frame[1:-2]
+        dt=timeit(lambda: server.decodeBuffer(block), count)
+        results.add('decodeBuffer.%s' % name, count/dt, 'blocks/s', 'higher')
+        dt=timeit(lambda: decode_frame(frame, 'bench'), count)
+        results.add('decode_frame.%s' % name, count/dt, 'frames/s', 'higher')
+
+
+def benchReceive(results, size):
+    (c, peer)=channel()
+    chunk=bytes(range(32, 128))*40
+    received=0
+    t0=time.perf_counter()
+    while received<size:
+        peer.write(chunk)
+        while c.receiveChar() is not None:
+            received+=1
+    dt=time.perf_counter()-t0
+    results.add('CommunicationChannel.receiveChar', dt*1e9/received, 'ns/byte', 'lower')
+
+
+def startPair(server=None):
+    (linkServer, linkClient)=LinkLoopback.pair(uniqueName('server'), uniqueName('equipment'))
+    if server is None:
+        server=Server(linkServer, logLevel=LOGLEVEL)
+    client=Client(linkClient, logLevel=LOGLEVEL)
+    return (server, client)
+
+
+def benchServer(results, count):
+    (server, client)=startPair()
+    server.start()
+    client.start()
+
+    latencies=[]
+    for n in range(min(count, 200)):
+        t0=time.perf_counter()
+        client.sendCall(n, 'latency')
+        if server.getNotification(5.0) is None:
+            break
+        latencies.append(time.perf_counter()-t0)
+    results.add('Server.latency.median', percentile(latencies, 0.5)*1000, 'ms', 'lower')
+    results.add('Server.latency.p99', percentile(latencies, 0.99)*1000, 'ms', 'lower')
+
+    t0=time.perf_counter()
+    for n in range(count):
+        client.sendCall(n, 'throughput')
+    received=0
+    while received<count and server.getNotification(5.0):
+        received+=1
+    dt=time.perf_counter()-t0
+    results.add('Server.throughput', received/dt, 'calls/s', 'higher')
+
+    client.stop()
+    server.stop()
+    client.waitForExit()
+    server.waitForExit()
+
+
+class BenchMultiChannelServer(MultiChannelServer):
+    def __init__(self):
+        super(BenchMultiChannelServer, self).__init__()
+        self._sent={}
+        self._latencies=[]
+        self._condition=threading.Condition()
+
+    def sent(self, key):
+        self._sent[key]=time.perf_counter()
+
+    def onNotification(self, notification):
+        t=time.perf_counter()
+        with self._condition:
+            try:
+                self._latencies.append(t-self._sent.pop((notification.source, notification.callAddress)))
+            except KeyError:
+                pass
+            self._condition.notify_all()
+
+    def wait(self, count, timeout):
+        with self._condition:
+            return self._condition.wait_for(lambda: len(self._latencies)>=count, timeout)
+
+    def latencies(self):
+        return self._latencies
+
+    def reset(self):
+        with self._condition:
+            self._latencies=[]
+
+
+def benchMultiChannel(results, channels, rounds):
+    mcs=BenchMultiChannelServer()
+    clients=[]
+    for n in range(channels):
+        (server, client)=startPair()
+        mcs.add(server)
+        clients.append((server.name, client))
+    for (name, client) in clients:
+        client.start()
+
+    thread=threading.Thread(target=mcs.run)
+    thread.daemon=True
+    thread.start()
+
+    # warmup (servers startup), not measured
+    for (name, client) in clients:
+        mcs.sent((name, 'warmup'))
+        client.sendCall('warmup', 'dispatch')
+    mcs.wait(channels, 30)
+    mcs.reset()
+
+    for r in range(rounds):
+        for (name, client) in clients:
+            mcs.sent((name, str(r)))
+            client.sendCall(r, 'dispatch')
+    mcs.wait(channels*rounds, 30)
+
+    latencies=mcs.latencies()
+    results.add('MultiChannelServer.dispatch.%d.median' % channels, percentile(latencies, 0.5)*1000, 'ms', 'lower')
+    results.add('MultiChannelServer.dispatch.%d.p99' % channels, percentile(latencies, 0.99)*1000, 'ms', 'lower')
+
+    for (name, client) in clients:
+        client.stop()
+    for (name, client) in clients:
+        client.waitForExit()
+    mcs.stopServers(False)
+    thread.join()
+
+
+def main():
+    parser=argparse.ArgumentParser(description='ESPA protocol stack benchmarks')
+    parser.add_argument('--output', help='write the results (JSON) to this file')
+    parser.add_argument('--baseline', help='compare the results with this baseline (JSON)')
+    parser.add_argument('--save-baseline', help='write the results as a new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative regression')
+    parser.add_argument('--quick', action='store_true', help='smaller iteration counts')
+    args=parser.parse_args()
+
+    scale=0.1 if args.quick else 1.0
+    results=Results()
+    benchDecode(results, int(50000*scale))
+    benchReceive(results, int(200000*scale))
+    benchServer(results, int(2000*scale))
+    for channels in (1, 4, 16, 64, 256):
+        benchMultiChannel(results, channels, max(5, int(20*scale)))
+
+    data=results.asDict()
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(data, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline=json.load(f)
+        if results.compare(baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__=='__main__':
+    sys.exit(main())
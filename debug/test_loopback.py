@@ -0,0 +1,35 @@
+import time
+import logging
+
+from digimat.espa import LinkLoopback, Server, Client
+
+
+# simulated control equipment (Client) driving a Server over an in-memory link
+
+(linkServer, linkClient)=LinkLoopback.pair('server', 'equipment')
+
+server=Server(linkServer, logLevel=logging.WARNING)
+client=Client(linkClient, logLevel=logging.WARNING)
+
+server.start()
+client.start()
+
+count=1000
+t0=time.time()
+for n in range(count):
+    client.sendCall(1000+n, 'message %d' % n)
+
+received=0
+while received<count:
+    notification=server.getNotification(1.0)
+    if notification is None:
+        break
+    received+=1
+
+dt=time.time()-t0
+print('%d/%d calls received in %.3fs (%.1f calls/s)' % (received, count, dt, received/dt))
+
+client.stop()
+server.stop()
+client.waitForExit()
+server.waitForExit()
@@ -0,0 +1,17 @@
+import sys
+import time
+
+from digimat.espa.simulation import fuzz
+
+
+# fault injection scenarios (noise, truncated blocks, bad BCC, stalled peer...)
+# run on a Server state machine under virtual time
+
+count=int(sys.argv[1]) if len(sys.argv)>1 else 2000
+seed=int(sys.argv[2]) if len(sys.argv)>2 else 0
+
+t0=time.time()
+stats=fuzz(count, seed)
+dt=time.time()-t0
+print('%d scenarios (%.0fs of virtual time) in %.3fs' % (stats['scenarios'], stats['virtual_time'], dt))
+print(stats)
@@ -1,2 +1,11 @@
-from .link import LinkSerial
+from .link import LinkSerial, LinkLoopback, LinkPty
 from .espa import Server, Client, MultiChannelServer
+from .aio import AsyncServer, AsyncMultiChannelServer
+from .frame import decode_frame
+from .notification import Notification, NotificationCallToPager, NotificationLinkTimeout
+from .notification import NotificationStatusInformation, NotificationStatusRequest, NotificationCallSubscriberLine
+from .tcp import LinkTCP, LinkTCPServer, TCPMultiChannelServer
+from .shard import ShardedMultiChannelServer
+from .journal import NotificationJournal
+from .dedup import DeduplicationCache
+from .routing import RoutingTable
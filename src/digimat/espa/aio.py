@@ -0,0 +1,181 @@
+import asyncio
+import inspect
+import logging
+
+from .codec import ESPA_CHARSET_DEFAULT
+from .espa import Server
+from .notification import Notification
+
+# asyncio engine : the ESPA session and message state machines are the ones
+# of Server, but they are driven by a single event loop instead of one thread
+# per channel. The loop wakes up when the link is readable (add_reader) or
+# when the next protocol deadline is reached.
+
+# used for links without a selectable file descriptor
+ESPA_ASYNC_POLL_INTERVAL = 0.02
+
+
+class AsyncServer(Server):
+    def __init__(self, link, contolEquipmentAddress='1', pagingSystemAddress='2', logServer='localhost', logLevel=logging.INFO, pipelined=True, charset=ESPA_CHARSET_DEFAULT, clock=None):
+        super(AsyncServer, self).__init__(link, contolEquipmentAddress, pagingSystemAddress, logServer, logLevel, pipelined, charset, clock)
+        self._queueAsyncNotifications=asyncio.Queue()
+        self._sharedQueue=False
+        self._eventData=None
+        self._fd=None
+
+    def setNotificationQueue(self, queue):
+        # used by AsyncMultiChannelServer to fan-in all the notifications
+        self._queueAsyncNotifications=queue
+        self._sharedQueue=True
+
+    def notify(self, notification):
+        if notification and isinstance(notification, Notification):
+            if not self.isDuplicate(notification):
+                self._queueAsyncNotifications.put_nowait(notification)
+            return True
+
+    def start(self):
+        return asyncio.ensure_future(self.run())
+
+    def stop(self):
+        super(AsyncServer, self).stop()
+        if self._eventData:
+            self._eventData.set()
+
+    def waitForExit(self):
+        self.stop()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._sharedQueue:
+            raise StopAsyncIteration
+        if not self.isRunning() and self._queueAsyncNotifications.empty():
+            raise StopAsyncIteration
+        notification=await self._queueAsyncNotifications.get()
+        if notification is None:
+            raise StopAsyncIteration
+        return notification
+
+    def _onReadable(self):
+        self._eventData.set()
+
+    def _watch(self, loop):
+        fd=self.channel.fileno()
+        if fd!=self._fd:
+            self._unwatch(loop)
+            if fd is not None:
+                loop.add_reader(fd, self._onReadable)
+                self._fd=fd
+        return self._fd
+
+    def _unwatch(self, loop):
+        if self._fd is not None:
+            try:
+                loop.remove_reader(self._fd)
+            except:
+                pass
+            self._fd=None
+
+    async def _waitData(self, fd, timeout):
+        if fd is None:
+            timeout=min(timeout, ESPA_ASYNC_POLL_INTERVAL)
+        try:
+            await asyncio.wait_for(self._eventData.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self):
+        loop=asyncio.get_running_loop()
+        self._eventData=asyncio.Event()
+        self.logger.info('starting async manager')
+        self.channel.open()
+
+        try:
+            while self.isRunning():
+                self._eventData.clear()
+                self.process()
+                fd=self._watch(loop)
+                await self._waitData(fd, self.nextTimeout())
+        except asyncio.CancelledError:
+            self.stop()
+            raise
+        except:
+            self.logger.exception('run()')
+            self.stop()
+        finally:
+            self._unwatch(loop)
+            self.channel.close()
+            if not self._sharedQueue:
+                self._queueAsyncNotifications.put_nowait(None)
+            self.logger.info("done")
+
+
+class AsyncMultiChannelServer(object):
+    def __init__(self):
+        self._servers={}
+        self._queueNotifications=asyncio.Queue()
+        self._tasks=[]
+
+    def add(self, server):
+        if server and isinstance(server, AsyncServer):
+            server.setNotificationQueue(self._queueNotifications)
+            self._servers[server.name]=server
+
+    def servers(self):
+        return list(self._servers.values())
+
+    def onNotification(self, notification):
+        # may be overriden by a regular method or by a coroutine
+        print(notification)
+        if notification.isName('calltopager'):
+            print("[%s]->paging(%s) with message <%s>..." % (notification.source,
+                notification.callAddress,
+                notification.message))
+
+    def _onServerDone(self, done):
+        if all(task.done() for task in self._tasks):
+            self._queueNotifications.put_nowait(None)
+
+    def start(self):
+        if not self._tasks:
+            for server in self.servers():
+                task=server.start()
+                task.add_done_callback(self._onServerDone)
+                self._tasks.append(task)
+
+    def stop(self):
+        for server in self.servers():
+            server.stop()
+
+    def __aiter__(self):
+        self.start()
+        return self
+
+    async def __anext__(self):
+        if not self._tasks:
+            raise StopAsyncIteration
+        notification=await self._queueNotifications.get()
+        if notification is None:
+            raise StopAsyncIteration
+        return notification
+
+    async def run(self):
+        if self._servers:
+            try:
+                async for notification in self:
+                    try:
+                        result=self.onNotification(notification)
+                        if inspect.isawaitable(result):
+                            await result
+                    except:
+                        logging.getLogger(__name__).exception('onNotification()')
+            finally:
+                self.stop()
+                await asyncio.gather(*self._tasks, return_exceptions=True)
+                self._tasks=[]
+
+
+if __name__=='__main__':
+    pass
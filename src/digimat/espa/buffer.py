@@ -0,0 +1,93 @@
+# Fixed capacity input buffer with read-index semantics.
+# Data is stored in a preallocated bytearray between a read index (start)
+# and a write index (end). Consuming data only moves the read index, and
+# the remaining data is moved back to the beginning of the storage only
+# when there is not enough room left at the end (compaction).
+
+ESPA_INPUT_BUFFER_SIZE = 4096
+
+
+class InputBuffer(object):
+    def __init__(self, capacity=ESPA_INPUT_BUFFER_SIZE):
+        self._capacity=capacity
+        self._buf=bytearray(capacity)
+        self._view=memoryview(self._buf)
+        self._start=0
+        self._end=0
+        # changed on every extend/consume/clear (see CommunicationChannel.waitData)
+        self._generation=0
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    def __len__(self):
+        return self._end-self._start
+
+    def free(self):
+        return self._capacity-(self._end-self._start)
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def clear(self):
+        self._start=0
+        self._end=0
+        self._generation+=1
+
+    def _compact(self):
+        size=self._end-self._start
+        if self._start>0:
+            if size>0:
+                self._buf[0:size]=self._buf[self._start:self._end]
+            self._start=0
+            self._end=size
+
+    def extend(self, data):
+        # append data, return the number of bytes stored (data beyond the
+        # buffer capacity is NOT stored)
+        size=len(data)
+        if size>self._capacity-self._end:
+            self._compact()
+            size=min(size, self._capacity-self._end)
+        if size>0:
+            self._view[self._end:self._end+size]=data[:size]
+            self._end+=size
+            self._generation+=1
+        return size
+
+    def peek(self, size=None):
+        # returned view is only valid until the next extend()
+        if size is None or size>self._end-self._start:
+            return self._view[self._start:self._end]
+        return self._view[self._start:self._start+size]
+
+    def find(self, sub, start=0):
+        # return the offset of sub relative to the read index, or -1
+        pos=self._buf.find(sub, self._start+start, self._end)
+        if pos>=0:
+            return pos-self._start
+        return -1
+
+    def consume(self, size):
+        self._generation+=1
+        self._start=min(self._start+size, self._end)
+        if self._start==self._end:
+            self._start=0
+            self._end=0
+
+    def read(self, size=None):
+        data=bytes(self.peek(size))
+        self.consume(len(data))
+        return data
+
+    def readByte(self):
+        if self._start<self._end:
+            b=self._buf[self._start]
+            self.consume(1)
+            return b
+
+
+if __name__=='__main__':
+    pass
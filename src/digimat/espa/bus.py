@@ -0,0 +1,306 @@
+import os
+import struct
+import logging
+import tempfile
+
+from collections import deque
+from threading import Lock
+from threading import Condition
+
+from .notification import Notification, notificationPriority
+
+# Blocking notification bus : any number of producers (the Server threads)
+# publish into a single queue, consumers wake up immediately and can drain
+# all the pending notifications at once.
+#
+# The bus may be bounded (maxSize : all the sources, maxPerSource : a single
+# channel). When a bound is reached, publish() applies the overflow policy
+#  - 'block' : wait for room, the notification is refused after blockTimeout
+#    or the timeout given to publish(), 0 refuses immediately (the server NAKs
+#    it, the control equipment sends it again later)
+#  - 'drop-oldest' : the oldest queued notification is dropped
+#  - 'drop-lowest-priority' : the oldest of the least urgent queued
+#    notifications is dropped (or the new one if it is even less urgent)
+#  - 'spill' : the notifications are written to an overflow file, read back
+#    in order as the consumer catches up
+# The dropped notifications are passed to onDrop(notification).
+
+ESPA_BUS_BLOCK = 'block'
+ESPA_BUS_DROP_OLDEST = 'drop-oldest'
+ESPA_BUS_DROP_LOWEST_PRIORITY = 'drop-lowest-priority'
+ESPA_BUS_SPILL = 'spill'
+
+# max time a producer waits for room ('block'), well under the answer
+# timeout of the control equipment (the NAK must reach it in time)
+ESPA_BUS_BLOCK_TIMEOUT = 1.0
+
+ESPA_SPILL_HEADER = struct.Struct('<I')
+
+
+class SpillFile(object):
+    # FIFO of notifications in an anonymous temporary file, truncated
+    # each time it has been fully read back
+    def __init__(self, path=None):
+        self._file=tempfile.TemporaryFile(prefix='espa-spill-', dir=path)
+        self._count=0
+        self._position=0
+        # next notification, read back but not consumed yet
+        self._head=None
+
+    def __len__(self):
+        return self._count
+
+    def append(self, notification):
+        payload=notification.toBytes()
+        f=self._file
+        f.seek(0, os.SEEK_END)
+        f.write(ESPA_SPILL_HEADER.pack(len(payload)))
+        f.write(payload)
+        self._count+=1
+
+    def peek(self):
+        # next notification (not consumed), None if empty
+        if self._head is None and self._count>0:
+            f=self._file
+            f.seek(self._position)
+            (size,)=ESPA_SPILL_HEADER.unpack(f.read(ESPA_SPILL_HEADER.size))
+            self._head=Notification.fromBytes(f.read(size))
+            self._position=f.tell()
+        return self._head
+
+    def pop(self):
+        notification=self.peek()
+        if notification is not None:
+            self._head=None
+            self._count-=1
+            if self._count==0:
+                self._file.seek(0)
+                self._file.truncate()
+                self._position=0
+        return notification
+
+    def close(self):
+        try:
+            self._file.close()
+        except:
+            pass
+
+
+class NotificationBus(object):
+    def __init__(self, maxSize=0, overflow=ESPA_BUS_BLOCK, maxPerSource=0, spillPath=None,
+            blockTimeout=ESPA_BUS_BLOCK_TIMEOUT, onDrop=None, logger=None):
+        if overflow not in (ESPA_BUS_BLOCK, ESPA_BUS_DROP_OLDEST, ESPA_BUS_DROP_LOWEST_PRIORITY, ESPA_BUS_SPILL):
+            raise ValueError('unknown overflow policy [%s]' % overflow)
+        self._logger=logger or logging.getLogger('ESPA-BUS')
+        self._queue=deque()
+        self._lock=Lock()
+        # consumers wait on _condition, blocked producers on _room
+        self._condition=Condition(self._lock)
+        self._room=Condition(self._lock)
+        # bounds (0 : unbounded)
+        self._maxSize=maxSize
+        self._maxPerSource=maxPerSource
+        self._overflow=overflow
+        self._blockTimeout=blockTimeout
+        self._onDrop=onDrop
+        self._spillPath=spillPath
+        self._spill=None
+        # queued notifications per source
+        self._sources={}
+        self._highWater=0
+        self._sourcesHighWater={}
+        self._dropped=0
+        self._refused=0
+        self._spilled=0
+
+    @property
+    def logger(self):
+        return self._logger
+
+    def __len__(self):
+        if self._spill:
+            return len(self._queue)+len(self._spill)
+        return len(self._queue)
+
+    def setDropHandler(self, onDrop):
+        self._onDrop=onDrop
+
+    def stats(self):
+        # sizes and high-water marks (aggregate and per source)
+        with self._condition:
+            return {'queued': len(self._queue),
+                    'spilled': len(self._spill) if self._spill else 0,
+                    'highwater': self._highWater,
+                    'sources': dict(self._sources),
+                    'sources_highwater': dict(self._sourcesHighWater),
+                    'dropped': self._dropped,
+                    'refused': self._refused,
+                    'spills': self._spilled}
+
+    def _isFull(self, source):
+        if self._maxSize>0 and len(self._queue)>=self._maxSize:
+            return True
+        if self._maxPerSource>0 and self._sources.get(source, 0)>=self._maxPerSource:
+            return True
+        return False
+
+    def _candidates(self, source):
+        # (index, notification) the overflow policy may drop : the notifications
+        # of the source if it has reached its own bound, else all of them
+        if self._maxPerSource>0 and self._sources.get(source, 0)>=self._maxPerSource:
+            return ((n, notification) for (n, notification) in enumerate(self._queue) if notification.source==source)
+        return enumerate(self._queue)
+
+    def _victim(self, notification):
+        # index of the queued notification to drop, None to drop the new one
+        candidates=self._candidates(notification.source)
+        if self._overflow==ESPA_BUS_DROP_OLDEST:
+            for (n, queued) in candidates:
+                return n
+            return None
+        victim=None
+        rank=None
+        for (n, queued) in candidates:
+            r=notificationPriority(queued)
+            if rank is None or r>rank:
+                (victim, rank)=(n, r)
+        if victim is None or notificationPriority(notification)>rank:
+            return None
+        return victim
+
+    def _count(self, source, delta):
+        count=self._sources.get(source, 0)+delta
+        if count>0:
+            self._sources[source]=count
+            if count>self._sourcesHighWater.get(source, 0):
+                self._sourcesHighWater[source]=count
+        else:
+            self._sources.pop(source, None)
+
+    def _append(self, notification):
+        self._queue.append(notification)
+        self._count(notification.source, 1)
+        size=len(self)
+        if size>self._highWater:
+            self._highWater=size
+
+    def _remove(self, index):
+        queue=self._queue
+        notification=queue[index]
+        del queue[index]
+        self._count(notification.source, -1)
+        return notification
+
+    def _spillOut(self, notification):
+        if self._spill is None:
+            self._spill=SpillFile(self._spillPath)
+            self.logger.warning('bus overflow, spilling notifications to disk')
+        self._spill.append(notification)
+        self._spilled+=1
+        size=len(self)
+        if size>self._highWater:
+            self._highWater=size
+
+    def _refill(self):
+        # read back the spilled notifications (they are newer than the queued
+        # ones) while the bounds allow it, in order
+        spill=self._spill
+        while spill:
+            notification=spill.peek()
+            if self._isFull(notification.source):
+                break
+            spill.pop()
+            self._queue.append(notification)
+            self._count(notification.source, 1)
+
+    def _removed(self):
+        self._refill()
+        if self._maxSize>0 or self._maxPerSource>0:
+            self._room.notify_all()
+
+    def publish(self, notification, timeout=None):
+        # return False if the notification has been refused (bus full)
+        # timeout : max wait for room ('block'), None for blockTimeout
+        if timeout is None:
+            timeout=self._blockTimeout
+        dropped=None
+        with self._condition:
+            if self._spill:
+                # spilled notifications pending : keep the order
+                self._spillOut(notification)
+                self._condition.notify()
+                return True
+            if self._isFull(notification.source):
+                if self._overflow==ESPA_BUS_SPILL:
+                    self._spillOut(notification)
+                    self._condition.notify()
+                    return True
+                if self._overflow==ESPA_BUS_BLOCK:
+                    if timeout<=0 or not self._room.wait_for(lambda: not self._isFull(notification.source), timeout):
+                        self._refused+=1
+                        self.logger.warning('bus overflow, %s refused', notification)
+                        return False
+                else:
+                    index=self._victim(notification)
+                    self._dropped+=1
+                    if index is None:
+                        dropped=notification
+                    else:
+                        dropped=self._remove(index)
+                    self.logger.warning('bus overflow, %s dropped', dropped)
+            if dropped is not notification:
+                self._append(notification)
+                self._condition.notify()
+
+        if dropped is not None and self._onDrop:
+            try:
+                self._onDrop(dropped)
+            except:
+                self.logger.exception('onDrop(%s)', dropped)
+        return True
+
+    def wakeup(self):
+        with self._condition:
+            self._condition.notify_all()
+            self._room.notify_all()
+
+    def get(self, timeout=None):
+        # timeout=0 : non blocking, timeout=None : wait forever
+        with self._condition:
+            if not self._queue and timeout!=0:
+                self._condition.wait(timeout)
+            if self._queue:
+                notification=self._queue.popleft()
+                self._count(notification.source, -1)
+                self._removed()
+                return notification
+
+    def drain(self, maxItems=0, timeout=None):
+        # wait for at least one notification and return all the pending ones
+        # (at most maxItems if maxItems>0)
+        with self._condition:
+            if not self._queue and timeout!=0:
+                self._condition.wait(timeout)
+            queue=self._queue
+            if not queue:
+                return []
+            if maxItems<=0 or maxItems>=len(queue):
+                items=list(queue)
+                queue.clear()
+                self._sources.clear()
+            else:
+                items=[queue.popleft() for n in range(maxItems)]
+                for notification in items:
+                    self._count(notification.source, -1)
+            self._removed()
+            return items
+
+    def close(self):
+        with self._condition:
+            if self._spill is not None:
+                self._spill.close()
+                self._spill=None
+
+
+if __name__=='__main__':
+    pass
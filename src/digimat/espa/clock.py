@@ -0,0 +1,53 @@
+import time
+
+# Time source of the protocol : the deadlines use now() (monotonic), the idle
+# waits use sleep(). The default Clock is the real time, a VirtualClock lets a
+# simulation (see simulation.py) run the state machines under virtual time,
+# minutes of protocol timeouts being stepped in microseconds.
+
+
+class Clock(object):
+    def now(self):
+        # monotonic time (seconds), used for the deadlines
+        return time.monotonic()
+
+    def time(self):
+        # wall clock time (seconds since epoch)
+        return time.time()
+
+    def sleep(self, delay):
+        if delay>0:
+            time.sleep(delay)
+
+
+class VirtualClock(Clock):
+    # virtual time, only moving when advanced (sleep() advances it, never blocks)
+    def __init__(self, start=0.0, epoch=1.0e9):
+        self._now=start
+        self._epoch=epoch
+
+    def now(self):
+        return self._now
+
+    def time(self):
+        return self._epoch+self._now
+
+    def sleep(self, delay):
+        self.advance(delay)
+
+    def advance(self, delay):
+        if delay>0:
+            self._now+=delay
+        return self._now
+
+    def advanceTo(self, t):
+        self._now=max(self._now, t)
+        return self._now
+
+
+# default (real time) clock
+ESPA_CLOCK = Clock()
+
+
+if __name__=='__main__':
+    pass
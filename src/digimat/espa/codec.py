@@ -0,0 +1,105 @@
+import codecs
+
+# ESPA character sets, registered with the codecs machinery
+#
+#   b'Gr\x5b\x7dn'.decode('espa_de') -> 'GrÄün'
+#   'Müller'.encode('espa_de') -> b'M}ller'
+#
+# ESPA 4.4.4 messages are 7 bits ISO 646 : the national variants replace a few
+# ASCII characters ([ \ ] { | } ...) by national letters. 8 bits data (outside
+# of the ESPA specification but sent by many systems) are decoded as latin-1,
+# so that decoding never fails and a call is never lost because of its message.
+#
+# 'espa' (international reference version) is exactly latin-1 and uses the C
+# latin-1 codec, the national variants use precomputed charmap tables (C too).
+
+ESPA_CHARSET_DEFAULT = 'espa'
+
+# national variants : ASCII character -> national character
+ESPA_CHARSETS = {
+    'espa': {},
+    'espa_de': {'@': '§', '[': 'Ä', '\\': 'Ö', ']': 'Ü', '{': 'ä', '|': 'ö', '}': 'ü', '~': 'ß'},
+    'espa_dk': {'[': 'Æ', '\\': 'Ø', ']': 'Å', '{': 'æ', '|': 'ø', '}': 'å'},
+    'espa_no': {'[': 'Æ', '\\': 'Ø', ']': 'Å', '{': 'æ', '|': 'ø', '}': 'å'},
+    'espa_se': {'[': 'Ä', '\\': 'Ö', ']': 'Å', '{': 'ä', '|': 'ö', '}': 'å'},
+    'espa_fr': {'#': '£', '@': 'à', '[': '°', '\\': 'ç', ']': '§', '{': 'é', '|': 'ù', '}': 'è', '~': '¨'},
+    'espa_ch': {'#': 'ù', '@': 'à', '[': 'é', '\\': 'ç', ']': 'ê', '^': 'î', '_': 'è', '`': 'ô',
+                '{': 'ä', '|': 'ö', '}': 'ü', '~': 'û'},
+    'espa_it': {'#': '£', '@': '§', '[': '°', '\\': 'ç', ']': 'é', '`': 'ù', '{': 'à', '|': 'ò',
+                '}': 'è', '~': 'ì'},
+}
+
+
+def _tables(variant):
+    # (decoding table, encoding table) of a national variant
+    decoding=[chr(n) for n in range(256)]
+    encoding=list(decoding)
+    for (ascii, national) in variant.items():
+        decoding[ord(ascii)]=national
+        encoding[ord(ascii)]=national
+        # national characters are encoded with their 7 bits code
+        if ord(national)<256:
+            encoding[ord(national)]='\ufffe'
+    return (''.join(decoding), codecs.charmap_build(''.join(encoding)))
+
+
+def _codec(name, variant):
+    if not variant:
+        encode=codecs.latin_1_encode
+        decode=codecs.latin_1_decode
+    else:
+        (decodingTable, encodingTable)=_tables(variant)
+
+        def encode(input, errors='strict'):
+            return codecs.charmap_encode(input, errors, encodingTable)
+
+        def decode(input, errors='strict'):
+            return codecs.charmap_decode(input, errors, decodingTable)
+
+    class IncrementalEncoder(codecs.IncrementalEncoder):
+        def encode(self, input, final=False):
+            return encode(input, self.errors)[0]
+
+    class IncrementalDecoder(codecs.IncrementalDecoder):
+        def decode(self, input, final=False):
+            return decode(input, self.errors)[0]
+
+    class StreamWriter(codecs.StreamWriter):
+        pass
+
+    class StreamReader(codecs.StreamReader):
+        pass
+
+    StreamWriter.encode=staticmethod(encode)
+    StreamReader.decode=staticmethod(decode)
+
+    return codecs.CodecInfo(name=name, encode=encode, decode=decode,
+        incrementalencoder=IncrementalEncoder,
+        incrementaldecoder=IncrementalDecoder,
+        streamwriter=StreamWriter,
+        streamreader=StreamReader)
+
+
+_codecs={}
+
+
+def search(name):
+    name=name.replace('-', '_')
+    try:
+        return _codecs[name]
+    except KeyError:
+        pass
+    try:
+        variant=ESPA_CHARSETS[name]
+    except KeyError:
+        return None
+    info=_codec(name, variant)
+    _codecs[name]=info
+    return info
+
+
+codecs.register(search)
+
+
+if __name__=='__main__':
+    pass
@@ -0,0 +1,106 @@
+import hashlib
+
+from threading import Lock
+from collections import OrderedDict
+
+from .clock import ESPA_CLOCK
+from .notification import NotificationCallToPager
+
+# Retransmission deduplication : a control equipment that missed an ACK sends
+# the same call again. A call already seen on the same channel (same address,
+# message, call type and priority) within the window is acknowledged but not
+# published a second time.
+#
+# Bounded TTL/LRU cache : entries are kept in insertion (expiration) order, the
+# expired ones are removed from the head and the oldest one is evicted when the
+# capacity is reached, every operation is O(1) (amortized). The key is either
+# a 128 bits fingerprint (hashed=True, small memory footprint) or the full tuple.
+
+ESPA_DEDUP_WINDOW = 30.0
+ESPA_DEDUP_CAPACITY = 65536
+
+
+class DeduplicationCache(object):
+    def __init__(self, window=ESPA_DEDUP_WINDOW, capacity=ESPA_DEDUP_CAPACITY, hashed=True, clock=None):
+        self._window=window
+        # time source of the expirations (see clock.py)
+        self._clock=clock or ESPA_CLOCK
+        self._capacity=max(1, capacity)
+        self._hashed=hashed
+        self._entries=OrderedDict()
+        self._lock=Lock()
+        self._hits=0
+        self._misses=0
+        self._evictions=0
+        self._expirations=0
+
+    @property
+    def window(self):
+        return self._window
+
+    def setClock(self, clock):
+        self._clock=clock
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'hits': self._hits,
+                    'misses': self._misses,
+                    'evictions': self._evictions,
+                    'expirations': self._expirations}
+
+    def key(self, notification):
+        # None if the notification is not subject to deduplication
+        if not isinstance(notification, NotificationCallToPager):
+            return None
+        key=(notification.source, notification.callAddress, notification.message,
+            notification.callType, notification.priority)
+        if self._hashed:
+            return hashlib.blake2b('\x1f'.join(str(field) for field in key).encode('utf8'),
+                digest_size=16).digest()
+        return key
+
+    def _expire(self, now):
+        entries=self._entries
+        while entries:
+            (key, expiration)=next(iter(entries.items()))
+            if expiration>now:
+                break
+            del entries[key]
+            self._expirations+=1
+
+    def isDuplicate(self, notification):
+        # True if already seen within the window, else remember it
+        key=self.key(notification)
+        if key is None:
+            return False
+        now=self._clock.now()
+        with self._lock:
+            self._expire(now)
+            if key in self._entries:
+                self._hits+=1
+                return True
+            self._misses+=1
+            self._entries[key]=now+self._window
+            if len(self._entries)>self._capacity:
+                self._entries.popitem(last=False)
+                self._evictions+=1
+            return False
+
+    def forget(self, notification):
+        # the notification has not been accepted after all (i.e. NAK)
+        key=self.key(notification)
+        if key is not None:
+            with self._lock:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+if __name__=='__main__':
+    pass
@@ -0,0 +1,198 @@
+import asyncio
+import inspect
+import logging
+
+from collections import deque
+from threading import Condition, Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
+
+# Notification dispatcher : handlers are run by a pool of worker threads.
+# Notifications of a given channel (source) are delivered in order, one at
+# a time, while different channels are delivered in parallel.
+#
+# The handler may be
+#  - a regular function, run in the worker thread (default)
+#  - a regular function run by an external executor (i.e. ProcessPoolExecutor,
+#    the handler and the notifications must then be picklable)
+#  - a coroutine function, run by a dedicated asyncio event loop thread
+#
+# The number of in flight notifications (queued+running) is bounded. When
+# the limit is reached, dispatch() applies the overflow policy
+#  - 'block' : wait until a notification has been handled
+#  - 'drop-newest' : the dispatched notification is dropped
+#  - 'drop-oldest' : the oldest queued (not yet running) notification is dropped
+
+ESPA_DISPATCH_BLOCK = 'block'
+ESPA_DISPATCH_DROP_NEWEST = 'drop-newest'
+ESPA_DISPATCH_DROP_OLDEST = 'drop-oldest'
+
+# max notifications handled for a channel before giving its worker back
+ESPA_DISPATCH_BATCH = 64
+
+
+class HandlerInvoker(object):
+    # call handler(notification) as the handler requires it
+    #  - a coroutine function (or a function returning an awaitable) is run
+    #    by a dedicated asyncio event loop thread
+    #  - with an executor, the handler is run by the executor (the handler and
+    #    the notification are pickled with a ProcessPoolExecutor), unless local
+    #  - else in the calling thread
+    def __init__(self, executor=None):
+        self._executor=executor
+        self._loop=None
+        self._lock=Lock()
+
+    def eventLoop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop=asyncio.new_event_loop()
+                thread=Thread(target=self._loop.run_forever)
+                thread.daemon=True
+                thread.start()
+            return self._loop
+
+    def invoke(self, handler, notification, local=False):
+        if inspect.iscoroutinefunction(handler):
+            result=handler(notification)
+        elif self._executor is not None and not local:
+            result=self._executor.submit(handler, notification).result()
+        else:
+            result=handler(notification)
+        if inspect.isawaitable(result):
+            return asyncio.run_coroutine_threadsafe(self.awaitable(result), self.eventLoop()).result()
+        return result
+
+    async def awaitable(self, result):
+        return await result
+
+    def close(self):
+        with self._lock:
+            if self._loop:
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._loop=None
+
+
+class NotificationDispatcher(object):
+    def __init__(self, handler, workers=4, maxInFlight=1024, overflow=ESPA_DISPATCH_BLOCK, executor=None, logger=None, onDrop=None):
+        if overflow not in (ESPA_DISPATCH_BLOCK, ESPA_DISPATCH_DROP_NEWEST, ESPA_DISPATCH_DROP_OLDEST):
+            raise ValueError('unknown overflow policy [%s]' % overflow)
+        self._logger=logger or logging.getLogger('ESPA-DISPATCHER')
+        self._handler=handler
+        # onDrop : optional callback(notification) of the dropped notifications
+        self._onDrop=onDrop
+        self._workers=ThreadPoolExecutor(max(1, workers))
+        self._invoker=HandlerInvoker(executor)
+        self._maxInFlight=max(1, maxInFlight)
+        self._overflow=overflow
+        self._condition=Condition()
+        self._channels={}
+        self._seq=0
+        self._inFlight=0
+        self._dropped=0
+        self._handled=0
+        self._errors=0
+
+    @property
+    def logger(self):
+        return self._logger
+
+    def stats(self):
+        with self._condition:
+            return {'inflight': self._inFlight,
+                    'handled': self._handled,
+                    'dropped': self._dropped,
+                    'errors': self._errors}
+
+    def _dropOldest(self):
+        # oldest queued notification among all the channels
+        oldest=None
+        for queue in self._channels.values():
+            if queue and (oldest is None or queue[0][0]<oldest[0][0]):
+                oldest=queue
+        if oldest:
+            (seq, notification)=oldest.popleft()
+            self._inFlight-=1
+            self._dropped+=1
+            return notification
+
+    def _overflowDrop(self, notification):
+        if notification is not None and self._onDrop:
+            try:
+                self._onDrop(notification)
+            except:
+                self.logger.exception('onDrop(%s)', notification)
+        return notification
+
+    def dispatch(self, notification):
+        source=notification.source
+        with self._condition:
+            while self._inFlight>=self._maxInFlight:
+                if self._overflow==ESPA_DISPATCH_BLOCK:
+                    self._condition.wait()
+                elif self._overflow==ESPA_DISPATCH_DROP_OLDEST and self._overflowDrop(self._dropOldest()):
+                    self.logger.warning('dispatcher overflow, oldest notification dropped')
+                else:
+                    self._dropped+=1
+                    self.logger.warning('dispatcher overflow, %s dropped', notification)
+                    self._overflowDrop(notification)
+                    return False
+
+            self._seq+=1
+            self._inFlight+=1
+            queue=self._channels.get(source)
+            if queue is not None:
+                # channel already scheduled, its worker will handle it
+                queue.append((self._seq, notification))
+                return True
+            self._channels[source]=deque([(self._seq, notification)])
+
+        self._workers.submit(self._run, source)
+        return True
+
+    def _call(self, notification):
+        return self._invoker.invoke(self._handler, notification)
+
+    def _run(self, source):
+        for count in range(ESPA_DISPATCH_BATCH):
+            with self._condition:
+                queue=self._channels[source]
+                if not queue:
+                    del self._channels[source]
+                    return
+                (seq, notification)=queue.popleft()
+
+            try:
+                self._call(notification)
+                error=False
+            except:
+                self.logger.exception('handler(%s)', notification)
+                error=True
+
+            with self._condition:
+                self._inFlight-=1
+                self._handled+=1
+                if error:
+                    self._errors+=1
+                self._condition.notify_all()
+
+        # give the worker back to the other channels
+        self._workers.submit(self._run, source)
+
+    def waitInFlight(self, limit, timeout=None):
+        # wait until less than limit notifications are in flight
+        with self._condition:
+            return self._condition.wait_for(lambda: self._inFlight<limit, timeout)
+
+    def join(self, timeout=None):
+        with self._condition:
+            return self._condition.wait_for(lambda: self._inFlight==0, timeout)
+
+    def shutdown(self, wait=True):
+        if wait:
+            self.join()
+        self._workers.shutdown(wait)
+        self._invoker.close()
+
+
+if __name__=='__main__':
+    pass
@@ -1,39 +1,71 @@
 import time
 import logging
-import logging.handlers
 
 from threading import Thread
 from threading import Event
-from queue import Queue
-
+from threading import Condition
+from collections import deque
+
+from .buffer import InputBuffer
+from .clock import ESPA_CLOCK
+from .codec import ESPA_CHARSET_DEFAULT
+from .bus import NotificationBus, ESPA_BUS_BLOCK
+from .dispatch import NotificationDispatcher, HandlerInvoker, ESPA_DISPATCH_BLOCK
+from .frame import ESPA_CHAR_SOH, ESPA_CHAR_STX, ESPA_CHAR_ETX, ESPA_CHAR_ENQ, ESPA_CHAR_ACK
+from .frame import ESPA_CHAR_NAK, ESPA_CHAR_EOT, ESPA_CHAR_US, ESPA_CHAR_RS, ESPA_BYTE_ETX
+from .frame import ESPA_BYTE_ACK, ESPA_BYTE_NAK, ESPA_BYTE_EOT
+from .frame import bcc, decode_block, encode_frame
+from .log import createLogger, WireTrace
+from .metrics import Metrics, MetricsHTTPServer
 from .notification import Notification, NotificationCallToPager, NotificationLinkTimeout
-
-# Communication Protocol ESPA 4.4.4
-# http://www.gscott.co.uk/ESPA.4.4.4/datablock.html
+from .notification import notificationPriority
+from .priority import NotificationPriorityQueue, ESPA_PRIORITY_AGING
+from .routing import RoutingTable
 
 ESPA_CLIENT_ACTIVITY_TIMEOUT = 120
 
-ESPA_CHAR_SOH = '\x01'
-ESPA_CHAR_STX = '\x02'
-ESPA_CHAR_ETX = '\x03'
-ESPA_CHAR_ENQ = '\x05'
-ESPA_CHAR_ACK = '\x06'
-ESPA_CHAR_NAK = '\x15'
-ESPA_CHAR_EOT = '\x04'
-ESPA_CHAR_US = '\x1F'
-ESPA_CHAR_RS = '\x1E'
+# max time a thread manager stays blocked waiting for data (stop() latency)
+ESPA_MANAGER_MAX_WAIT = 1.0
+
+# client (control equipment side) timings
+ESPA_CLIENT_ANSWER_TIMEOUT = 3.0
+ESPA_CLIENT_RETRY_DELAY = 1.0
+ESPA_CLIENT_RELEASE_DELAY = 0.2
+
+# output queue : retry delay while the link is not writable, and max pending
+# bytes (a stalled link must not grow the queue forever)
+ESPA_OUTPUT_RETRY_DELAY = 0.005
+ESPA_OUTPUT_MAX_PENDING = 65536
+
+# max time a server waits for room on a full notification bus before NAKing
+# the call, bounded by the deadline of the message being answered minus a
+# margin (the NAK must reach the control equipment before its own timeout)
+ESPA_PUBLISH_MAX_WAIT = 1.0
+ESPA_PUBLISH_DEADLINE_MARGIN = 1.0
 
 
 class CommunicationChannel(object):
-    def __init__(self, link, logger):
+    def __init__(self, link, logger, charset=ESPA_CHARSET_DEFAULT, clock=None):
         self._logger=logger
         link.setLogger(logger)
+        # time source (see clock.py), shared with the link
+        self._clock=clock or ESPA_CLOCK
+        link.setClock(self._clock)
         self._link=link
+        # ESPA character set of the messages (codec, see codec.py)
+        self._charset=charset
         self._dead=False
         self._eventDead=Event()
-        self._activityTimeout=time.time()+ESPA_CLIENT_ACTIVITY_TIMEOUT
-        self._inbuf=None
-        self.reset()
+        self._activityDelay=ESPA_CLIENT_ACTIVITY_TIMEOUT
+        self.resetActivityTimeout()
+        self._inbuf=InputBuffer()
+        # input buffer generation at the last waitData()
+        self._waitGeneration=None
+        # output queue, coalesced and drained by flush()
+        self._outbuf=bytearray()
+        self._trace=WireTrace()
+        self._metrics=Metrics()
+        link.setMetrics(self._metrics)
 
     @property
     def logger(self):
@@ -43,8 +75,32 @@ class CommunicationChannel(object):
     def name(self):
         return self._link.name
 
+    @property
+    def link(self):
+        return self._link
+
+    @property
+    def charset(self):
+        return self._charset
+
+    @property
+    def clock(self):
+        return self._clock
+
+    @property
+    def trace(self):
+        return self._trace
+
+    @property
+    def metrics(self):
+        return self._metrics
+
+    def dumpTrace(self):
+        return self._trace.dump()
+
     def setDead(self, state=True):
         if state and not self._eventDead.isSet():
+            self._metrics.inc('link_dead')
             self._eventDead.set()
         self._dead=bool(state)
 
@@ -64,70 +120,150 @@ class CommunicationChannel(object):
     def reset(self):
         self.logger.info('reset()')
         self._link.reset()
-        self._inbuf=bytearray()
+        self._inbuf.clear()
 
     def open(self):
         return self._link.open()
 
     def close(self):
+        self.flush()
+        self._outbuf.clear()
         return self._link.close()
 
-    def receive(self, size=0):
-        if time.time()>self._activityTimeout:
+    def fileno(self):
+        return self._link.fileno()
+
+    def waitData(self, timeout):
+        # buffered data only wakes up the state machine if it has changed
+        # since the last wait (else it is waiting for more, i.e. a partial
+        # block, and the link must be waited for)
+        generation=self._inbuf.generation
+        if self._inbuf and generation!=self._waitGeneration:
+            self._waitGeneration=generation
+            return True
+        self._waitGeneration=generation
+        return self._link.waitData(timeout)
+
+    def nextTimeout(self):
+        return self._activityTimeout
+
+    def setActivityTimeout(self, timeout):
+        # max silence (seconds) before the link is declared dead, 0 : never
+        # (i.e. an inbound TCP connection, that may simply be idle)
+        self._activityDelay=timeout
+        self.resetActivityTimeout()
+
+    def resetActivityTimeout(self):
+        if self._activityDelay:
+            self._activityTimeout=self._clock.now()+self._activityDelay
+        else:
+            self._activityTimeout=float('inf')
+
+    def fill(self):
+        if self._clock.now()>self._activityTimeout:
             self.logger.warning('client activity timeout !')
             self.setDead(True)
             self.close()
-            self._activityTimeout=time.time()+60
+            self._activityTimeout=self._clock.now()+60
 
-        bufsize=len(self._inbuf)
-        if size==0 or size>bufsize:
-            # fill the input buffer
-            data=self._link.read()
+        size=self._inbuf.free()
+        if size>0:
+            data=self._link.read(min(size, 255))
             if data:
-                self.logger.debug('RX[%s]' % self.dataToString(data))
+                self._trace.record('RX', data)
+                self._metrics.inc('rx_bytes', len(data))
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug('RX[%s]', self.dataToString(data))
                 self._inbuf.extend(data)
-                self._activityTimeout=time.time()+ESPA_CLIENT_ACTIVITY_TIMEOUT
+                self.resetActivityTimeout()
+        return self._inbuf
 
-        try:
-            if size>0:
-                if bufsize>=size:
-                    data=self._inbuf[:size]
-                    self._inbuf=self._inbuf[size:]
-                    return data
-            else:
-                data=self._inbuf
-                self._inbuf=bytearray()
-                return data
-        except:
-            pass
+    @property
+    def inbuf(self):
+        return self._inbuf
+
+    def receive(self, size=0):
+        if size==0 or size>len(self._inbuf):
+            self.fill()
+
+        bufsize=len(self._inbuf)
+        if size>0:
+            if bufsize>=size:
+                return self._inbuf.read(size)
+        elif bufsize>0:
+            return self._inbuf.read()
+
+    def receiveUntil(self, sep):
+        # return all the buffered data up to (and including) sep
+        pos=self._inbuf.find(sep)
+        if pos<0:
+            self.fill()
+            pos=self._inbuf.find(sep)
+        if pos>=0:
+            return self._inbuf.read(pos+1)
 
     def receiveChar(self):
-        try:
-            return chr(self.receive(1)[0])
-        except:
-            pass
+        if not self._inbuf:
+            self.fill()
+        b=self._inbuf.readByte()
+        if b is not None:
+            return chr(b)
 
     def send(self, data):
+        # queue data (in order), written by the next flush()
         if data:
             if isinstance(data, str):
-                data=bytearray(data)
-            self.logger.debug('TX[%s]' % self.dataToString(data))
-            return self._link.write(data)
+                data=data.encode(self._charset, 'replace')
+            self._trace.record('TX', data)
+            self._metrics.inc('tx_bytes', len(data))
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('TX[%s]', self.dataToString(data))
+            if len(self._outbuf)+len(data)>ESPA_OUTPUT_MAX_PENDING:
+                self.logger.warning('output queue overflow, %d bytes dropped', len(self._outbuf))
+                self._metrics.inc('output_overflow')
+                self._outbuf.clear()
+            self._outbuf.extend(data)
+            return True
+
+    def pendingOutput(self):
+        return len(self._outbuf)
+
+    def flush(self):
+        # write the queued data with a single non blocking write, what the
+        # link doesn't accept now stays queued. Return True if fully written
+        outbuf=self._outbuf
+        if not outbuf:
+            return True
+        t0=time.perf_counter()
+        count=self._link.writeSome(bytes(outbuf))
+        self._metrics.observe('write_latency', time.perf_counter()-t0)
+        if count is None:
+            # link error (closed), the session will be restarted
+            self._metrics.inc('write_errors')
+            outbuf.clear()
+        elif count>0:
+            del outbuf[:count]
+        if outbuf:
+            self._metrics.inc('write_stalls')
+        self._metrics.set('output_queue', len(outbuf))
+        return not outbuf
 
     def sendChar(self, c):
-        self.send(bytearray(c, 'utf8'))
+        self.send(c)
 
     def ack(self):
         self.logger.debug('>ACK')
-        self.sendChar(ESPA_CHAR_ACK)
+        self._metrics.inc('ack_sent')
+        self.send(ESPA_BYTE_ACK)
 
     def eot(self):
         self.logger.debug('>EOT')
-        self.sendChar(ESPA_CHAR_EOT)
+        self.send(ESPA_BYTE_EOT)
 
     def nak(self):
         self.logger.debug('>NAK')
-        self.sendChar(ESPA_CHAR_NAK)
+        self._metrics.inc('nak_sent')
+        self.send(ESPA_BYTE_NAK)
 
 
 class MessageServer(object):
@@ -137,7 +273,7 @@ class MessageServer(object):
         self._state=0
         self._stateTimeout=0
         self._inbuf=None
-        self._bcc=0
+        self._sohTime=None
 
     @property
     def logger(self):
@@ -149,13 +285,25 @@ class MessageServer(object):
 
     def setTimeout(self, timeout):
         if timeout is not None:
-            self._stateTimeout=time.time()+timeout
+            self._stateTimeout=self.channel.clock.now()+timeout
 
     def setState(self, state, timeout=None):
         self._state=state
-        self.logger.debug('setMessageState(%d)' % state)
+        self.logger.debug('setMessageState(%d)', state)
         self.setTimeout(timeout)
 
+    @property
+    def state(self):
+        return self._state
+
+    @property
+    def sohTime(self):
+        return self._sohTime
+
+    def nextTimeout(self):
+        if self._state!=0:
+            return self._stateTimeout
+
     def setNextState(self, timeout=None):
         self.setState(self._state+1, timeout)
 
@@ -175,8 +323,9 @@ class MessageServer(object):
                 self.abort()
 
     def stateMachineManager(self):
-        if self._state!=0 and time.time()>=self._stateTimeout:
-            self.logger.warning('message state %d timeout!' % self._state)
+        if self._state!=0 and self.channel.clock.now()>=self._stateTimeout:
+            self.logger.warning('message state %d timeout!', self._state)
+            self.channel.metrics.inc('message_timeouts', 1, ('state', self._state))
             return False
         # --------------------------------------
         # reset
@@ -187,33 +336,31 @@ class MessageServer(object):
         # wait for 'SOH'
         elif self._state==1:
             if self.waitChar(ESPA_CHAR_SOH):
-                self._inbuf=bytearray()
-                self._bcc=0
+                self._sohTime=self.channel.clock.now()
+                self._inbuf=None
                 self.setNextState(3.0)
                 self.logger.debug('<SOH>OK, WAITING FOR BLOCK <DATA>+<ETX>')
         # --------------------------------------
-        # wait for block <data>+<ETX>
+        # wait for block <data>+<ETX> (whole block at once)
         elif self._state==2:
-            while True:
-                c=self.channel.receiveChar()
-                if c is None:
-                    break
-                self._bcc ^= ord(c)
-                if c==ESPA_CHAR_ETX:
-                    self.logger.debug('<ETX>OK, WAITING FOR BCC')
-                    self.setNextState()
-                    break
-                else:
-                    self._inbuf.extend(c.encode())
+            block=self.channel.receiveUntil(ESPA_BYTE_ETX)
+            if block:
+                self._inbuf=block
+                self.logger.debug('<ETX>OK, WAITING FOR BCC')
+                self.setNextState()
         # --------------------------------------
         # wait for 'BCC'
         elif self._state==3:
             c=self.channel.receiveChar()
             if c:
-                if ord(c)==self._bcc:
+                if ord(c)==bcc(self._inbuf):
                     self.logger.debug('<BCC>OK')
-                    return self.decodeBuffer(self._inbuf)
+                    notification=self.decodeBuffer(self._inbuf[:-1])
+                    if notification:
+                        return notification
+                    return False
                 self.logger.error('<BCC>invalid')
+                self.channel.metrics.inc('bcc_errors')
                 return False
         # --------------------------------------
         # bad state
@@ -223,49 +370,31 @@ class MessageServer(object):
     def decodeBuffer(self, buf):
         if buf:
             try:
-                (header, body)=buf.decode('ascii').split(ESPA_CHAR_STX)
-                if header and body:
-                    data={}
-                    for record in body.split(ESPA_CHAR_RS):
-                        if record:
-                            (did, dvalue)=record.split(ESPA_CHAR_US)
-                            data[str(did)]=str(dvalue)
-
-                    notification=None
-                    if header=='1':
-                        notification=NotificationCallToPager(self.channel.name, data)
-                    else:
-                        # '2'=Status Information,
-                        # '3'=Status Request,
-                        # '4'=Call subscriber line
-                        self.logger.warning('yet unsupported function [%s]' % header)
-
-                    if notification:
-                        if notification.validate():
-                            return notification
+                notification=decode_block(buf, self.channel.name, self.channel.charset)
+                if notification is None:
+                    self.logger.warning('unsupported or invalid data block [%s]', self.channel.dataToString(buf))
+                return notification
             except:
                 self.logger.exception('decodeBuffer()')
 
 
 class Communicator(object):
-    def __init__(self, link, contolEquipmentAddress='1', pagingSystemAddress='2', logServer='localhost', logLevel=logging.DEBUG):
-        logger=logging.getLogger("ESPA-SERVER:%s" % link.name)
-        logger.setLevel(logLevel)
-        socketHandler = logging.handlers.SocketHandler(logServer,
-            logging.handlers.DEFAULT_TCP_LOGGING_PORT)
-        logger.addHandler(socketHandler)
-        self._logger=logger
+    def __init__(self, link, contolEquipmentAddress='1', pagingSystemAddress='2', logServer='localhost', logLevel=logging.INFO, role='SERVER', charset=ESPA_CHARSET_DEFAULT, clock=None):
+        self._logger=createLogger("ESPA-%s:%s" % (role, link.name), logServer, logLevel)
 
         self._controlEquipmentAddress=contolEquipmentAddress
         self._pagingSystemAddress=pagingSystemAddress
 
-        self._channel=CommunicationChannel(link, self._logger)
+        self._channel=CommunicationChannel(link, self._logger, charset, clock)
 
         self._eventStop=Event()
         self._thread=Thread(target=self._manager)
         self._thread.daemon=True
 
-        self._queueNotifications=Queue()
+        self._queueNotifications=NotificationBus()
+        self._publishTimeout=ESPA_PUBLISH_MAX_WAIT
+        self._journal=None
+        self._dedup=None
 
     @property
     def logger(self):
@@ -279,6 +408,14 @@ class Communicator(object):
     def channel(self):
         return self._channel
 
+    def dumpTrace(self):
+        # last raw RX/TX data of the channel
+        return self.channel.dumpTrace()
+
+    @property
+    def metrics(self):
+        return self.channel.metrics
+
     def start(self):
         self.logger.info('starting thread manager')
         self._thread.start()
@@ -287,15 +424,95 @@ class Communicator(object):
         if not self._eventStop.isSet():
             self._eventStop.set()
 
+    def setNotificationBus(self, bus):
+        # shared bus (i.e. MultiChannelServer) : notifications from all the
+        # servers are published into the same bus
+        self._queueNotifications=bus
+
+    @property
+    def notificationBus(self):
+        return self._queueNotifications
+
+    def setPublishTimeout(self, timeout):
+        # max wait for room on a full bus, 0 : refused immediately (i.e.
+        # servers sharing a single loop must never block it)
+        self._publishTimeout=max(0, timeout)
+
+    def publishTimeout(self):
+        return self._publishTimeout
+
+    def setJournal(self, journal):
+        # durable journal (NotificationJournal) : notifications are journaled
+        # before being published (and acknowledged)
+        self._journal=journal
+
+    @property
+    def journal(self):
+        return self._journal
+
+    def setDeduplicationCache(self, dedup):
+        # retransmission deduplication (DeduplicationCache), may be shared
+        self._dedup=dedup
+
+    @property
+    def deduplicationCache(self):
+        return self._dedup
+
+    def isDuplicate(self, notification):
+        if self._dedup is not None and self._dedup.isDuplicate(notification):
+            self.logger.info('duplicate %s ignored', notification)
+            self.channel.metrics.inc('duplicates')
+            return True
+        return False
+
+    def journalize(self, notification):
+        if self._journal:
+            try:
+                self._journal.append(notification)
+            except:
+                self.logger.exception('journal.append(%s)', notification)
+                return False
+        return True
+
     def notify(self, notification):
+        # return False if the notification can't be accepted (not journaled)
+        # duplicates (retransmissions) are accepted but not published
         if notification and isinstance(notification, Notification):
-            self._queueNotifications.put(notification)
+            if self.isDuplicate(notification):
+                return True
+            if not self.journalize(notification):
+                if self._dedup is not None:
+                    self._dedup.forget(notification)
+                return False
+            if not self._queueNotifications.publish(notification, self.publishTimeout()):
+                # bus full : refused (NAK), the call will be sent again
+                self.metrics.inc('refused')
+                if self._dedup is not None:
+                    self._dedup.forget(notification)
+                if self._journal:
+                    self._journal.commit(notification.sequence)
+                return False
+            return True
 
-    def getNotification(self):
-        try:
-            return self._queueNotifications.get(False)
-        except:
-            pass
+    def getNotification(self, timeout=0):
+        return self._queueNotifications.get(timeout)
+
+    def stateMachineSignature(self):
+        return None
+
+    def stateMachineManager(self):
+        pass
+
+    def stateMachineRun(self, maxSteps=256):
+        # run the state machine until it stops making progress
+        # (i.e. waiting for more data or for a timeout), then write
+        # everything it has sent in one go
+        for step in range(maxSteps):
+            signature=self.stateMachineSignature()
+            self.stateMachineManager()
+            if self.stateMachineSignature()==signature:
+                break
+        self.channel.flush()
 
     def _manager(self):
         self.stop()
@@ -311,26 +528,37 @@ class Communicator(object):
 
 
 class Server(Communicator):
-    def __init__(self, link, contolEquipmentAddress='1', pagingSystemAddress='2', logServer='localhost', logLevel=logging.DEBUG):
-        super(Server, self).__init__(link, contolEquipmentAddress, pagingSystemAddress, logServer, logLevel)
+    def __init__(self, link, contolEquipmentAddress='1', pagingSystemAddress='2', logServer='localhost', logLevel=logging.INFO, pipelined=True, charset=ESPA_CHARSET_DEFAULT, clock=None):
+        super(Server, self).__init__(link, contolEquipmentAddress, pagingSystemAddress, logServer, logLevel, 'SERVER', charset, clock)
         self._state=0
         self._stateTimeout=0
         self._messageServer=None
+        # pipelined : bytes already received are kept between transactions,
+        # input is only flushed on resync (line noise, timeouts), never
+        # before the first transaction
+        self._pipelined=pipelined
+        self._flush=False
 
     def setTimeout(self, timeout):
         if timeout is not None:
-            self._stateTimeout=time.time()+timeout
+            self._stateTimeout=self.channel.clock.now()+timeout
 
     def setState(self, state, timeout=None):
         self._state=state
-        self.logger.debug('setServerState(%d)' % state)
+        self.logger.debug('setServerState(%d)', state)
         self.setTimeout(timeout)
 
     def setNextState(self, timeout=None):
         self.setState(self._state+1, timeout)
 
-    def resetState(self):
+    def setFlush(self, flush):
+        # flush the input at the next reset (False for a fresh link : the
+        # first bytes sent by the peer may already be waiting)
+        self._flush=flush
+
+    def resetState(self, flush=True):
         self.channel.eot()
+        self._flush=flush
         self.setState(0)
 
     def waitChar(self, c):
@@ -345,23 +573,37 @@ class Server(Communicator):
                 # reject stream incoherence
                 self.resetState()
 
+    def skipToChar(self, c):
+        # consume the input up to c, without any reply (i.e. the EOT ending
+        # the previous session, or line noise between two sessions)
+        while True:
+            data=self.channel.receiveChar()
+            if not data:
+                return False
+            if data==c:
+                return True
+            self.logger.debug('%02X skipped', ord(data))
+
     def stateMachineManager(self):
         # ESPA state machine
-        if self._state!=0 and time.time()>=self._stateTimeout:
-            self.logger.warning('state %d timeout!' % self._state)
+        if self._state!=0 and self.channel.clock.now()>=self._stateTimeout:
+            self.logger.warning('state %d timeout!', self._state)
+            self.channel.metrics.inc('state_timeouts', 1, ('state', self._state))
             self.resetState()
 
         # --------------------------------------
         # reset
         if self._state==0:
-            self.channel.reset()
+            if self._flush or not self._pipelined:
+                self.channel.reset()
+                self._flush=False
             self._messageServer=None
             self.setNextState(60)
             self.logger.debug('WAITING FOR <1>')
         # --------------------------------------
         # wait for '1'
         elif self._state==1:
-            if self.waitChar(self._controlEquipmentAddress):
+            if self.skipToChar(self._controlEquipmentAddress):
                 # from here we let 2500ms to get the initial
                 # '1' + ENQ + '2' + ENQ sequence
                 self.setNextState(2.5)
@@ -398,15 +640,23 @@ class Server(Communicator):
                 # if content is False : job terminated, but failed
                 # if content is None : job is running (come back later)
 
-                if notification:
-                    self.logger.info(str(notification))
-                    self.notify(notification)
+                if notification and self.notify(notification) is False:
+                    # not accepted (journal failure) : the control equipment will retry
+                    self.channel.sendChar(self._controlEquipmentAddress)
+                    self.channel.nak()
+                    self.resetState(False)
+                elif notification:
+                    self.logger.info('%s', notification)
                     self.channel.ack()
-                    self.resetState()
+                    metrics=self.channel.metrics
+                    metrics.inc('transactions')
+                    if self._messageServer.sohTime:
+                        metrics.observe('soh_ack_latency', self.channel.clock.now()-self._messageServer.sohTime)
+                    self.resetState(False)
                 elif notification is False:
                     self.channel.sendChar(self._controlEquipmentAddress)
                     self.channel.nak()
-                    self.resetState()
+                    self.resetState(False)
                 else:
                     pass
         # --------------------------------------
@@ -414,15 +664,49 @@ class Server(Communicator):
         else:
             self.resetState()
 
+    def stateMachineSignature(self):
+        messageServer=self._messageServer
+        if messageServer:
+            return (self._state, messageServer, messageServer.state)
+        return (self._state, None, None)
+
+    def publishTimeout(self):
+        # the NAK of a refused call must be sent before the deadline of the
+        # message being answered
+        timeout=self._publishTimeout
+        messageServer=self._messageServer
+        if timeout>0 and messageServer:
+            deadline=messageServer.nextTimeout()
+            if deadline is not None:
+                timeout=min(timeout, max(0, deadline-ESPA_PUBLISH_DEADLINE_MARGIN-self.channel.clock.now()))
+        return timeout
+
+    def nextTimeout(self):
+        # delay (seconds) before the next protocol deadline
+        if self._state==0:
+            return 0
+        deadlines=[self._stateTimeout, self.channel.nextTimeout()]
+        if self._messageServer:
+            timeout=self._messageServer.nextTimeout()
+            if timeout is not None:
+                deadlines.append(timeout)
+        delay=max(0, min(deadlines)-self.channel.clock.now())
+        if self.channel.pendingOutput():
+            return min(delay, ESPA_OUTPUT_RETRY_DELAY)
+        return delay
+
+    def process(self):
+        self.stateMachineRun()
+        if self.channel.isDeadEvent():
+            self.notify(NotificationLinkTimeout(self.channel.name))
+
     def _manager(self):
         self.channel.open()
 
         while not self._eventStop.isSet():
             try:
-                self.stateMachineManager()
-                if self.channel.isDeadEvent():
-                    self.notify(NotificationLinkTimeout(self.channel.name))
-                time.sleep(0.1)
+                self.process()
+                self.channel.waitData(min(self.nextTimeout(), ESPA_MANAGER_MAX_WAIT))
             except:
                 self.logger.exception('run()')
                 self.stop()
@@ -431,13 +715,105 @@ class Server(Communicator):
 
 
 class MultiChannelServer(object):
-    def __init__(self):
+    def __init__(self, workers=0, maxInFlight=1024, overflow=ESPA_DISPATCH_BLOCK, executor=None, journal=None, dedup=None,
+            maxQueued=0, maxQueuedPerChannel=0, queueOverflow=ESPA_BUS_BLOCK, spillPath=None,
+            priority=False, aging=ESPA_PRIORITY_AGING, routes=None, clock=None):
         self._servers={}
+        # time source (see clock.py) of the priority aging, and of the dedup
+        # cache and routing table if given
+        self._clock=clock or ESPA_CLOCK
+        # routes (RoutingTable, or the path of a JSON routes file) : the
+        # notifications are delivered to the handler of their route
+        if routes is not None and not isinstance(routes, RoutingTable):
+            routes=RoutingTable(routes, clock=self._clock)
+        elif routes is not None and clock is not None:
+            routes.setClock(clock)
+        self._routes=routes
+        # bus bounds (all the channels, a single channel) and overflow policy
+        # (see NotificationBus), spillPath : directory of the overflow file
+        self._bus=NotificationBus(maxQueued, queueOverflow, maxQueuedPerChannel, spillPath, onDrop=self.dropped)
+        # dedup (DeduplicationCache) : retransmitted calls are not delivered twice
+        if dedup is not None and clock is not None:
+            dedup.setClock(clock)
+        self._dedup=dedup
+        # journal (NotificationJournal) : notifications are journaled before
+        # the ACK, committed once delivered and replayed by run() if undelivered
+        self._journal=journal
+        # workers>0 (or executor) : onNotification() is called by a pool of
+        # workers (see NotificationDispatcher) instead of the run() loop
+        self._dispatcher=None
+        if workers>0 or executor is not None:
+            self._dispatcher=NotificationDispatcher(self.deliver, workers or 4,
+                maxInFlight, overflow, onDrop=self.dropped)
+        # the handlers (not deliver(), which commits the journal) are called by
+        # the invoker : awaited if async, run by the executor if picklable
+        self._invoker=HandlerInvoker(executor)
+        # priority : the notifications are delivered by ESPA priority (FIFO
+        # within a level, with aging) instead of FIFO. The backlog is kept in
+        # the priority queue, the dispatcher only gets <workers> at a time
+        self._priorityQueue=None
+        if priority:
+            self._priorityQueue=NotificationPriorityQueue(aging, self._clock)
+        self._priorityWindow=workers or 4
+
+    @property
+    def journal(self):
+        return self._journal
+
+    @property
+    def deduplicationCache(self):
+        return self._dedup
 
     def add(self, server):
         if server and isinstance(server, Server):
+            server.setNotificationBus(self._bus)
+            server.setJournal(self._journal)
+            server.setDeduplicationCache(self._dedup)
             self._servers[server.name]=server
 
+    @property
+    def routingTable(self):
+        return self._routes
+
+    def setRoutingTable(self, routes):
+        self._routes=routes
+
+    @property
+    def clock(self):
+        return self._clock
+
+    def addRoute(self, target, address=None, prefix=None, range=None, source=None, name=None):
+        # route by exact address, address prefix or (numeric) address range,
+        # source channel and notification name. target : handler(notification)
+        # or name (see RoutingTable.setTarget() and onRoute())
+        if self._routes is None:
+            self._routes=RoutingTable(clock=self._clock)
+        return self._routes.addRoute(target, address, prefix, range, source, name)
+
+    def onRoute(self, target, notification):
+        # notification routed to a target name without handler
+        self.onNotification(notification)
+
+    def route(self, notification):
+        # deliver the notification to the handler of its route (if any)
+        if self._routes is not None:
+            route=self._routes.lookup(notification)
+            if route is not None:
+                target=route.target
+                if callable(target):
+                    return self.invoke(target, notification)
+                handler=self._routes.target(target)
+                if handler is not None:
+                    return self.invoke(handler, notification)
+                return self.invoke(lambda notification: self.onRoute(target, notification), notification, True)
+        return self.invoke(self.onNotification, notification)
+
+    def invoke(self, handler, notification, local=False):
+        # the methods of the server can't be sent to an executor (not picklable)
+        if getattr(handler, '__self__', None) is self:
+            local=True
+        return self._invoker.invoke(handler, notification, local)
+
     def onNotification(self, notification):
         print(notification)
         if notification.isName('calltopager'):
@@ -448,35 +824,351 @@ class MultiChannelServer(object):
     def servers(self):
         return list(self._servers.values())
 
-    def run(self):
+    def dumpTrace(self, name):
+        try:
+            return self._servers[name].dumpTrace()
+        except KeyError:
+            pass
+
+    def startServers(self):
         if self._servers:
-            stop=False
             for server in self.servers():
                 server.start()
+            return True
+
+    def isRunning(self):
+        for server in self.servers():
+            if not server.isRunning():
+                return False
+        return True
 
+    def stopServers(self, wait=True):
+        for server in self.servers():
+            server.stop()
+        if wait:
+            for server in self.servers():
+                server.waitForExit()
+
+    def deliver(self, notification):
+        try:
+            server=self._servers[notification.source]
+            server.metrics.observe('queue_wait', time.time()-notification.timestamp,
+                ('priority', notificationPriority(notification)))
+        except KeyError:
+            pass
+        self.route(notification)
+        # committed once handled : a notification whose handler raised is
+        # replayed by the next run() (with the ones delivered after it)
+        if self._journal:
+            self._journal.commit(notification.sequence)
+
+    def dropped(self, notification):
+        # dropped by the bus or the dispatcher (overflow) : won't be replayed
+        if self._journal:
+            self._journal.commit(notification.sequence)
+
+    def dispatch(self, notification):
+        if self._dispatcher:
+            self._dispatcher.dispatch(notification)
+        else:
+            self.deliver(notification)
+
+    def dispatchByPriority(self, timeout=ESPA_MANAGER_MAX_WAIT):
+        # move the published notifications to the priority queue, then
+        # dispatch the most urgent one (if the dispatcher has room for it)
+        queue=self._priorityQueue
+        for notification in self._bus.drain(timeout=0 if queue else timeout):
+            queue.push(notification)
+        if queue:
+            if self._dispatcher and not self._dispatcher.waitInFlight(self._priorityWindow, timeout):
+                return
+            self.dispatch(queue.pop())
+
+    def replay(self):
+        # dispatch the journaled notifications not delivered by a previous run
+        count=0
+        if self._journal:
+            for notification in self._journal.replay():
+                self.dispatch(notification)
+                count+=1
+        return count
+
+    def queueStats(self):
+        # bus sizes and high-water marks
+        return self._bus.stats()
+
+    def updateQueueMetrics(self):
+        stats=self._bus.stats()
+        for server in self.servers():
+            server.metrics.set('queue_depth', stats['sources'].get(server.name, 0))
+            server.metrics.set('queue_highwater', stats['sources_highwater'].get(server.name, 0))
+
+    def metrics(self):
+        # {channel name: metrics snapshot}
+        self.updateQueueMetrics()
+        return {server.name: server.metrics.snapshot() for server in self.servers()}
+
+    def startMetricsServer(self, port=9464, host='127.0.0.1'):
+        # local HTTP endpoint, Prometheus text format
+        server=MetricsHTTPServer(self, host, port)
+        server.start()
+        return server
+
+    def run(self):
+        self.replay()
+        if self.startServers():
+            stop=False
             while not stop:
                 try:
-                    for server in self.servers():
-                        if server.isRunning():
-                            notification=server.getNotification()
-                            if notification:
-                                self.onNotification(notification)
-                        else:
-                            stop=True
-                    time.sleep(0.1)
+                    if self._priorityQueue is not None:
+                        self.dispatchByPriority()
+                    else:
+                        for notification in self._bus.drain(timeout=ESPA_MANAGER_MAX_WAIT):
+                            self.dispatch(notification)
+                    if not self.isRunning():
+                        stop=True
                 except:
                     stop=True
-                    for server in self.servers():
-                        server.stop()
+                    self.stopServers(False)
 
-            for server in self.servers():
-                server.waitForExit()
+            self.stopServers()
+
+            # notifications still queued (or spilled) by the bus
+            while True:
+                notifications=self._bus.drain(timeout=0)
+                if not notifications:
+                    break
+                for notification in notifications:
+                    if self._priorityQueue is not None:
+                        self._priorityQueue.push(notification)
+                    else:
+                        self.dispatch(notification)
+            while self._priorityQueue:
+                self.dispatch(self._priorityQueue.pop())
+            self._bus.close()
+
+            if self._dispatcher:
+                self._dispatcher.shutdown()
+            self._invoker.close()
+            if self._journal:
+                self._journal.sync()
 
 
 class Client(Communicator):
-    def __init__(self, link, contolEquipmentAddress='1', pagingSystemAddress='2', logServer='localhost', logLevel=logging.DEBUG):
-        super(Server, self).__init__('CLIENT', link, contolEquipmentAddress, pagingSystemAddress, logServer, logLevel)
-        # TODO:
+    def __init__(self, link, contolEquipmentAddress='1', pagingSystemAddress='2', logServer='localhost', logLevel=logging.INFO, retries=3, charset=ESPA_CHARSET_DEFAULT, clock=None):
+        super(Client, self).__init__(link, contolEquipmentAddress, pagingSystemAddress, logServer, logLevel, 'CLIENT', charset, clock)
+        self._state=0
+        self._stateTimeout=0
+        self._retries=retries
+        self._retry=0
+        self._queueOutbound=deque()
+        self._conditionOutbound=Condition()
+        self._busy=False
+        self._peerReleases=None
+
+    def send(self, notification):
+        # queue a block (i.e. NotificationCallToPager) to be sent to the paging system
+        if notification and isinstance(notification, Notification) and notification.function:
+            with self._conditionOutbound:
+                self._queueOutbound.append(notification)
+                self._conditionOutbound.notify_all()
+            return True
+
+    def sendCall(self, callAddress, message, beepCoding=None, callType=None, priority=None):
+        return self.send(NotificationCallToPager.create(callAddress, message,
+            beepCoding, callType, priority, self.name))
+
+    def pending(self):
+        return len(self._queueOutbound)
+
+    def stop(self):
+        super(Client, self).stop()
+        with self._conditionOutbound:
+            self._conditionOutbound.notify_all()
+
+    def join(self, timeout=None):
+        # wait until every queued call has been processed
+        with self._conditionOutbound:
+            return self._conditionOutbound.wait_for(lambda: not self._queueOutbound and not self._busy, timeout)
+
+    def setTimeout(self, timeout):
+        if timeout is not None:
+            self._stateTimeout=self.channel.clock.now()+timeout
+
+    def setState(self, state, timeout=None):
+        self._state=state
+        self.logger.debug('setClientState(%d)', state)
+        self.setTimeout(timeout)
+
+    def setBusy(self, state):
+        with self._conditionOutbound:
+            self._busy=state
+            self._conditionOutbound.notify_all()
+
+    def endSession(self, eot=True, delay=None):
+        if eot:
+            self.channel.eot()
+        if delay:
+            # retry later
+            self.setState(5, delay)
+        else:
+            self.setState(0)
+
+    def popCall(self):
+        with self._conditionOutbound:
+            self._queueOutbound.popleft()
+            self._retry=0
+            self._conditionOutbound.notify_all()
+
+    def retryCall(self, reason):
+        self._retry+=1
+        if self._retry>self._retries:
+            self.logger.error('call %s dropped (%s)', self._queueOutbound[0], reason)
+            self.popCall()
+            return False
+        self.logger.warning('call %s retry %d (%s)', self._queueOutbound[0], self._retry, reason)
+        return True
+
+    def peerReleased(self):
+        # EOT received from the paging system ? (other data is kept for the
+        # next session, but the link is still read so that waitData() blocks)
+        eot=ESPA_BYTE_EOT
+        if self.channel.inbuf.find(eot)!=0:
+            self.channel.fill()
+        if self.channel.inbuf.find(eot)==0:
+            self.channel.receive(1)
+            return True
+
+    def waitRelease(self):
+        # Some paging systems close the session (EOT) after each block, others
+        # accept several blocks per session. This is learned on the first
+        # block, then the next queued calls are either pipelined in the same
+        # session or sent in a new session as soon as the EOT is received
+        if self._peerReleases is False:
+            self.nextBlock()
+        elif self._peerReleases:
+            self.setState(4, ESPA_CLIENT_ANSWER_TIMEOUT)
+        else:
+            self.setState(4, ESPA_CLIENT_RELEASE_DELAY)
+
+    def nextBlock(self):
+        if self._queueOutbound:
+            self.setState(2)
+        else:
+            self.endSession()
+
+    def stateMachineSignature(self):
+        return (self._state, len(self._queueOutbound))
+
+    def stateMachineManager(self):
+        if self._state==4 and self.channel.clock.now()>=self._stateTimeout and not self.peerReleased():
+            # no EOT : the paging system accepts more blocks in this session
+            self._peerReleases=False
+            self.nextBlock()
+            return
+
+        if self._state in (1, 3) and self.channel.clock.now()>=self._stateTimeout:
+            self.logger.warning('state %d timeout!', self._state)
+            if self._state==3:
+                self.retryCall('timeout')
+            self.endSession(True, ESPA_CLIENT_RETRY_DELAY)
+            return
+
+        # --------------------------------------
+        # idle, start a session if some calls are queued
+        if self._state==0:
+            if self._queueOutbound:
+                self.setBusy(True)
+                self.channel.reset()
+                self.channel.resetActivityTimeout()
+                self.channel.send(('%s%s%s%s' % (self._controlEquipmentAddress, ESPA_CHAR_ENQ,
+                    self._pagingSystemAddress, ESPA_CHAR_ENQ)).encode('ascii'))
+                self.setState(1, ESPA_CLIENT_ANSWER_TIMEOUT)
+                self.logger.debug('<1><ENQ><2><ENQ>, WAITING FOR <ACK>')
+            elif self._busy:
+                self.setBusy(False)
+        # --------------------------------------
+        # wait for the paging system 'ACK'
+        elif self._state==1:
+            c=self.channel.receiveChar()
+            if c==ESPA_CHAR_ACK:
+                self.logger.debug('<ACK>OK, SESSION OPENED')
+                self.setState(2)
+            elif c in (ESPA_CHAR_NAK, ESPA_CHAR_EOT):
+                self.logger.warning('session refused by the paging system')
+                self.endSession(True, ESPA_CLIENT_RETRY_DELAY)
+        # --------------------------------------
+        # send the next queued call
+        elif self._state==2:
+            if self._queueOutbound:
+                notification=self._queueOutbound[0]
+                self.channel.send(encode_frame(notification.function, notification.data, self.channel.charset))
+                self.setState(3, ESPA_CLIENT_ANSWER_TIMEOUT)
+                self.logger.debug('<BLOCK> sent, WAITING FOR <ACK>')
+            else:
+                self.endSession()
+        # --------------------------------------
+        # wait for the block 'ACK'
+        elif self._state==3:
+            c=self.channel.receiveChar()
+            if c==ESPA_CHAR_ACK:
+                self.logger.info('%s sent', self._queueOutbound[0])
+                self.popCall()
+                self.waitRelease()
+            elif c==ESPA_CHAR_NAK:
+                self.retryCall('NAK')
+                self.waitRelease()
+            elif c==ESPA_CHAR_EOT:
+                # session closed by the paging system before the block
+                # was acknowledged, the block will be sent again
+                self.endSession(False)
+        # --------------------------------------
+        # wait for a possible 'EOT' from the paging system
+        elif self._state==4:
+            if self.peerReleased():
+                # session closed by the paging system, open a new one if needed
+                self._peerReleases=True
+                self.endSession(False)
+        # --------------------------------------
+        # wait before retrying
+        elif self._state==5:
+            if self.channel.clock.now()>=self._stateTimeout:
+                self.setState(0)
+        # --------------------------------------
+        # bad state
+        else:
+            self.endSession()
+
+    def nextTimeout(self):
+        if self._state==2:
+            return 0
+        if self.channel.pendingOutput():
+            return ESPA_OUTPUT_RETRY_DELAY
+        if self._state==0:
+            if self._queueOutbound:
+                return 0
+            return None
+        return max(0, min(self._stateTimeout, self.channel.nextTimeout())-self.channel.clock.now())
+
+    def _manager(self):
+        self.channel.open()
+
+        while not self._eventStop.isSet():
+            try:
+                self.stateMachineRun()
+                timeout=self.nextTimeout()
+                if timeout is None:
+                    # idle, wait for a call to be queued
+                    with self._conditionOutbound:
+                        if not self._queueOutbound:
+                            self._conditionOutbound.wait(ESPA_MANAGER_MAX_WAIT)
+                else:
+                    self.channel.waitData(min(timeout, ESPA_MANAGER_MAX_WAIT))
+            except:
+                self.logger.exception('run()')
+                self.stop()
+
+        self.channel.close()
 
 
 if __name__=='__main__':
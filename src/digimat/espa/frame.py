@@ -0,0 +1,107 @@
+import codecs
+import functools
+import operator
+
+from .codec import ESPA_CHARSET_DEFAULT
+from .notification import notificationClass
+
+# Communication Protocol ESPA 4.4.4
+# http://www.gscott.co.uk/ESPA.4.4.4/datablock.html
+
+ESPA_CHAR_SOH = '\x01'
+ESPA_CHAR_STX = '\x02'
+ESPA_CHAR_ETX = '\x03'
+ESPA_CHAR_ENQ = '\x05'
+ESPA_CHAR_ACK = '\x06'
+ESPA_CHAR_NAK = '\x15'
+ESPA_CHAR_EOT = '\x04'
+ESPA_CHAR_US = '\x1F'
+ESPA_CHAR_RS = '\x1E'
+
+ESPA_BYTE_SOH = b'\x01'
+ESPA_BYTE_ETX = b'\x03'
+ESPA_BYTE_ACK = b'\x06'
+ESPA_BYTE_NAK = b'\x15'
+ESPA_BYTE_EOT = b'\x04'
+
+
+def bcc(data):
+    # XOR of all the bytes of data. Long blocks are folded as a big integer
+    # (half against half) which is much faster than a per byte loop
+    size=len(data)
+    if size<64:
+        return functools.reduce(operator.xor, data, 0)
+    value=int.from_bytes(data, 'little')
+    while size>1:
+        half=(size+1)//2
+        bits=half*8
+        value=(value & ((1 << bits)-1)) ^ (value >> bits)
+        size=half
+    return value
+
+
+_codecs={}
+
+
+def codec(charset):
+    # (encode, decode) functions of the charset, cached (no registry lookup)
+    try:
+        return _codecs[charset]
+    except KeyError:
+        info=codecs.lookup(charset)
+        _codecs[charset]=(info.encode, info.decode)
+        return _codecs[charset]
+
+
+def decode_block(block, source=None, charset=ESPA_CHARSET_DEFAULT):
+    # block is <header><STX><data records> (without SOH, ETX and BCC)
+    # return the decoded Notification, None if the function is not supported
+    # (or the notification not valid) and raise ValueError if malformed
+    (header, stx, body)=codec(charset)[1](block)[0].partition(ESPA_CHAR_STX)
+    if not stx or not header or not body:
+        raise ValueError('malformed data block')
+
+    data={}
+    for record in body.split(ESPA_CHAR_RS):
+        if record:
+            (did, us, dvalue)=record.partition(ESPA_CHAR_US)
+            if not us:
+                raise ValueError('malformed data record')
+            data[did]=dvalue
+
+    cls=notificationClass(header)
+    if cls is None:
+        return None
+
+    notification=cls(source, data)
+    if notification.validate():
+        return notification
+
+
+def decode_frame(frame, source=None, charset=ESPA_CHARSET_DEFAULT):
+    # frame is [SOH]<header><STX><data records><ETX><BCC>
+    frame=memoryview(frame)
+    if frame[:1]==ESPA_BYTE_SOH:
+        frame=frame[1:]
+    if len(frame)<2 or frame[-2:-1]!=ESPA_BYTE_ETX:
+        raise ValueError('missing ETX/BCC')
+    if bcc(frame[:-1])!=frame[-1]:
+        raise ValueError('invalid BCC')
+    return decode_block(frame[:-2], source, charset)
+
+
+def encode_block(header, data, charset=ESPA_CHARSET_DEFAULT):
+    # return <header><STX><data records><ETX>, records sorted by identifier
+    # (characters not available in the charset are replaced by '?')
+    records=ESPA_CHAR_RS.join('%s%s%s' % (did, ESPA_CHAR_US, data[did]) for did in sorted(data))
+    return codec(charset)[0]('%s%s%s%s' % (header, ESPA_CHAR_STX, records, ESPA_CHAR_ETX), 'replace')[0]
+
+
+def encode_frame(header, data, charset=ESPA_CHARSET_DEFAULT):
+    # return the complete frame <SOH><header><STX><data records><ETX><BCC>
+    block=encode_block(header, data, charset)
+    return ESPA_BYTE_SOH+block+bytes((bcc(block),))
+
+
+if __name__=='__main__':
+    pass
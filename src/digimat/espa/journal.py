@@ -0,0 +1,352 @@
+import os
+import mmap
+import zlib
+import time
+import struct
+import logging
+
+from threading import Thread
+from threading import Condition
+
+from .notification import Notification
+
+# Durable notification journal : every notification is appended to a memory
+# mapped, segmented, append-only log *before* the ESPA ACK is sent, and is
+# committed by the consumer once delivered (onNotification). The undelivered
+# notifications are replayed at the next startup, the fully committed segments
+# are deleted (compaction).
+#
+# Writing into the mmap is a memory copy (it survives a process crash), a
+# background thread makes it durable with msync. The appenders waiting for the
+# durability (sync=True) are grouped by a single msync (group commit), so a
+# burst of notifications from many channels costs one flush per batch.
+#
+# Segment file <first sequence>.journal, preallocated, records
+#   <length:uint32><crc32:uint32><sequence:uint64><payload:length bytes>
+# a zero length ends the segment. The payload is Notification.toBytes().
+
+ESPA_JOURNAL_SEGMENT_SIZE = 4*1024*1024
+ESPA_JOURNAL_HEADER = struct.Struct('<IIQ')
+ESPA_JOURNAL_EXTENSION = '.journal'
+
+# period of the consumer offsets save and of the compaction
+ESPA_JOURNAL_OFFSETS_PERIOD = 1.0
+
+
+class JournalSegment(object):
+    def __init__(self, path, first, size=ESPA_JOURNAL_SEGMENT_SIZE):
+        self._path=path
+        self._first=first
+        fd=os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size<size:
+                os.ftruncate(fd, size)
+            self._size=os.fstat(fd).st_size
+            self._mmap=mmap.mmap(fd, self._size)
+        finally:
+            os.close(fd)
+        self._position=0
+        self._flushed=0
+        self._last=first-1
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def first(self):
+        return self._first
+
+    @property
+    def last(self):
+        return self._last
+
+    def records(self):
+        # yield (end position, sequence, payload) of the valid records
+        header=ESPA_JOURNAL_HEADER
+        position=0
+        expected=self._first
+        while position+header.size<=self._size:
+            (length, crc, seq)=header.unpack_from(self._mmap, position)
+            end=position+header.size+length
+            if length==0 or end>self._size or seq!=expected:
+                break
+            payload=self._mmap[position+header.size:end]
+            if zlib.crc32(payload)!=crc:
+                break
+            yield (end, seq, payload)
+            position=end
+            expected+=1
+
+    def recover(self):
+        # position after the last valid record (a torn write is overwritten)
+        for (end, seq, payload) in self.records():
+            self._position=end
+            self._last=seq
+        self._flushed=self._position
+        return self._last
+
+    def fits(self, size):
+        return self._position+ESPA_JOURNAL_HEADER.size+size<=self._size
+
+    def append(self, seq, payload):
+        header=ESPA_JOURNAL_HEADER
+        position=self._position
+        end=position+header.size+len(payload)
+        self._mmap[position+header.size:end]=payload
+        header.pack_into(self._mmap, position, len(payload), zlib.crc32(payload), seq)
+        # terminate the segment after the record (stale data of a previous run)
+        terminator=min(self._size, end+header.size)
+        self._mmap[end:terminator]=bytes(terminator-end)
+        self._position=end
+        self._last=seq
+
+    def flush(self):
+        position=self._position
+        if position>self._flushed:
+            start=(self._flushed//mmap.PAGESIZE)*mmap.PAGESIZE
+            self._mmap.flush(start, min(self._size, position+ESPA_JOURNAL_HEADER.size)-start)
+            self._flushed=position
+
+    def close(self):
+        try:
+            self._mmap.close()
+        except:
+            pass
+
+
+class NotificationJournal(object):
+    def __init__(self, path, segmentSize=ESPA_JOURNAL_SEGMENT_SIZE, sync=True, consumer='default', logger=None):
+        # sync : append() waits until the record has been flushed to disk
+        self._logger=logger or logging.getLogger('ESPA-JOURNAL')
+        self._path=path
+        self._segmentSize=segmentSize
+        self._sync=sync
+        self._consumer=consumer
+        self._condition=Condition()
+        self._segments=[]
+        self._dirty=[]
+        self._readers=0
+        self._stop=False
+        self._appended=0
+        self._flushes=0
+
+        os.makedirs(path, exist_ok=True)
+        for name in sorted(os.listdir(path)):
+            if name.endswith(ESPA_JOURNAL_EXTENSION):
+                try:
+                    first=int(name[:-len(ESPA_JOURNAL_EXTENSION)])
+                except ValueError:
+                    continue
+                self._segments.append(JournalSegment(os.path.join(path, name), first, segmentSize))
+
+        self._seq=0
+        if self._segments:
+            self._seq=self._segments[-1].recover()
+        self._flushedSeq=self._seq
+
+        self._offset=self.loadOffset()
+        if self._segments:
+            self._offset=max(self._offset, self._segments[0].first-1)
+        self._offset=min(self._offset, self._seq)
+        self._savedOffset=self._offset
+        self._done=set()
+
+        self._thread=Thread(target=self._flusher)
+        self._thread.daemon=True
+        self._thread.start()
+
+    @property
+    def logger(self):
+        return self._logger
+
+    @property
+    def sequence(self):
+        # last appended sequence
+        return self._seq
+
+    @property
+    def offset(self):
+        # last committed sequence (every sequence up to it has been delivered)
+        return self._offset
+
+    def pending(self):
+        return self._seq-self._offset
+
+    def stats(self):
+        with self._condition:
+            return {'sequence': self._seq,
+                    'offset': self._offset,
+                    'pending': self._seq-self._offset,
+                    'segments': len(self._segments),
+                    'appended': self._appended,
+                    'flushes': self._flushes}
+
+    def offsetPath(self):
+        return os.path.join(self._path, '%s.offset' % self._consumer)
+
+    def loadOffset(self):
+        try:
+            with open(self.offsetPath()) as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def saveOffset(self, offset):
+        path=self.offsetPath()
+        tmp=path+'.tmp'
+        with open(tmp, 'w') as f:
+            f.write('%d\n' % offset)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def _segment(self, size):
+        # current segment, a new one is created when full
+        segment=None
+        if self._segments:
+            segment=self._segments[-1]
+        if segment is None or not segment.fits(size):
+            first=self._seq+1
+            segment=JournalSegment(os.path.join(self._path, '%020d%s' % (first, ESPA_JOURNAL_EXTENSION)),
+                first, max(self._segmentSize, ESPA_JOURNAL_HEADER.size*2+size))
+            self._segments.append(segment)
+        return segment
+
+    def append(self, notification):
+        # journal the notification, return its sequence
+        payload=notification.toBytes()
+        with self._condition:
+            if self._stop:
+                raise ValueError('journal closed')
+            segment=self._segment(len(payload))
+            seq=self._seq+1
+            segment.append(seq, payload)
+            self._seq=seq
+            self._appended+=1
+            if not self._dirty or self._dirty[-1] is not segment:
+                self._dirty.append(segment)
+            notification.setSequence(seq)
+            self._condition.notify_all()
+            if self._sync:
+                while self._flushedSeq<seq and not self._stop:
+                    self._condition.wait()
+        return seq
+
+    def commit(self, seq):
+        # the notification <seq> has been delivered, the offset follows the
+        # contiguous delivered sequences (out of order deliveries are allowed)
+        if seq is None:
+            return
+        with self._condition:
+            if seq>self._offset:
+                self._done.add(seq)
+                while self._offset+1 in self._done:
+                    self._offset+=1
+                    self._done.discard(self._offset)
+
+    def replay(self):
+        # yield the journaled notifications not yet committed
+        with self._condition:
+            segments=list(self._segments)
+            offset=self._offset
+            limit=self._seq
+            self._readers+=1
+        try:
+            for n in range(len(segments)):
+                if n+1<len(segments) and segments[n+1].first<=offset+1:
+                    continue
+                for (end, seq, payload) in segments[n].records():
+                    if seq>limit:
+                        return
+                    if seq<=offset:
+                        continue
+                    try:
+                        notification=Notification.fromBytes(payload)
+                        notification.setSequence(seq)
+                    except:
+                        self.logger.exception('replay(%d)', seq)
+                        self.commit(seq)
+                        continue
+                    yield notification
+        finally:
+            with self._condition:
+                self._readers-=1
+
+    def compact(self):
+        # delete the segments whose records have all been committed
+        with self._condition:
+            if self._readers:
+                return
+            while len(self._segments)>1 and self._segments[1].first<=self._savedOffset+1:
+                if self._segments[0] in self._dirty:
+                    break
+                segment=self._segments.pop(0)
+                segment.close()
+                try:
+                    os.remove(segment.path)
+                    self.logger.debug('segment %s removed', segment.path)
+                except OSError:
+                    self.logger.exception('compact()')
+
+    def _flush(self):
+        # one msync per dirty segment for all the records appended so far
+        with self._condition:
+            target=self._seq
+            segments=self._dirty
+            self._dirty=[]
+        try:
+            for segment in segments:
+                segment.flush()
+        except:
+            self.logger.exception('flush()')
+        with self._condition:
+            self._flushedSeq=max(self._flushedSeq, target)
+            self._flushes+=1
+            self._condition.notify_all()
+
+    def _saveOffset(self):
+        offset=self._offset
+        if offset!=self._savedOffset:
+            try:
+                self.saveOffset(offset)
+                self._savedOffset=offset
+                self.compact()
+            except:
+                self.logger.exception('saveOffset()')
+
+    def sync(self):
+        # flush the records, save the consumer offset and compact
+        self._flush()
+        self._saveOffset()
+
+    def _flusher(self):
+        offsetsTimeout=time.monotonic()+ESPA_JOURNAL_OFFSETS_PERIOD
+        while True:
+            with self._condition:
+                while self._flushedSeq==self._seq and not self._stop:
+                    delay=offsetsTimeout-time.monotonic()
+                    if delay<=0:
+                        break
+                    self._condition.wait(delay)
+                stop=self._stop
+            self._flush()
+            if stop or time.monotonic()>=offsetsTimeout:
+                offsetsTimeout=time.monotonic()+ESPA_JOURNAL_OFFSETS_PERIOD
+                self._saveOffset()
+            if stop:
+                break
+
+    def close(self):
+        with self._condition:
+            self._stop=True
+            self._condition.notify_all()
+        self._thread.join()
+        with self._condition:
+            for segment in self._segments:
+                segment.close()
+            self._segments=[]
+
+
+if __name__=='__main__':
+    pass
@@ -1,7 +1,12 @@
-import time
+import os
+import select
 import serial
+
+from threading import Condition
 from serial.tools import list_ports
 
+from .clock import ESPA_CLOCK
+
 # pyserial docs
 # http://pyserial.sourceforge.net/pyserial_api.html
 
@@ -17,10 +22,14 @@ from serial.tools import list_ports
 # FTDI drivers
 # http://www.ftdichip.com/Drivers/VCP.htm
 
+ESPA_SERIAL_REOPEN_DELAY = 15
+
 
 class Link(object):
     def __init__(self, name):
         self._logger=None
+        self._metrics=None
+        self._clock=ESPA_CLOCK
         if not name:
             name='espalink'
         self.setName(name)
@@ -28,6 +37,16 @@ class Link(object):
     def setLogger(self, logger):
         self._logger=logger
 
+    def setMetrics(self, metrics):
+        self._metrics=metrics
+
+    def setClock(self, clock):
+        self._clock=clock
+
+    @property
+    def clock(self):
+        return self._clock
+
     def setName(self, name):
         self._name=name
 
@@ -48,12 +67,28 @@ class Link(object):
     def close(self):
         pass
 
-    def read(self):
+    def fileno(self):
+        # file descriptor usable with select/poll/asyncio, if any
+        return None
+
+    def waitData(self, timeout):
+        # block until data is (probably) available or timeout (seconds) expired
+        # default implementation for links without any wait support
+        self._clock.sleep(min(timeout, 0.1))
+        return True
+
+    def read(self, size=255):
         return None
 
     def write(self, data):
         return False
 
+    def writeSome(self, data):
+        # non blocking write : return the number of bytes written (0 if the
+        # link is not writable now), None on error. Default : blocking write()
+        if self.write(data):
+            return len(data)
+
 
 # see http://pyserial.sourceforge.net/pyserial_api.html#urls for url allowed syntax
 class LinkSerial(Link):
@@ -70,6 +105,7 @@ class LinkSerial(Link):
         if rtscts:
             self._rtscts=1
         self._reopenTimeout=0
+        self._pending=None
 
     @classmethod
     def listPorts(cls):
@@ -79,10 +115,11 @@ class LinkSerial(Link):
         if self._serial:
             return True
         try:
-            if time.time()>self._reopenTimeout:
-                self._reopenTimeout=time.time()+15
-                self.logger.info('open(%s)' % (self._url))
-
+            if self._clock.now()>=self._reopenTimeout:
+                self._reopenTimeout=self._clock.now()+ESPA_SERIAL_REOPEN_DELAY
+                self.logger.info('open(%s)', self._url)
+                if self._metrics:
+                    self._metrics.inc('reopen_attempts')
                 s=serial.serial_for_url(self._url)
                 s.baudrate=self._baudrate
                 s.parity=self._parity
@@ -98,7 +135,7 @@ class LinkSerial(Link):
                     pass
 
                 self._serial=s
-                self.logger.info('port(%s) opened' % self._url)
+                self.logger.info('port(%s) opened', self._url)
                 return True
         except:
             self.logger.exception('open()')
@@ -107,22 +144,65 @@ class LinkSerial(Link):
 
     def close(self):
         try:
-            self.logger.info('close(%s)' % self._url)
+            self.logger.info('close(%s)', self._url)
             self._serial.setDTR(0)
             self._serial.setCTS(0)
             self._serial.close()
         except:
             pass
         self._serial=None
+        self._pending=None
+
+    def fileno(self):
+        try:
+            return self._serial.fileno()
+        except:
+            pass
+
+    def waitData(self, timeout):
+        if self._pending:
+            return True
+        if not self.open():
+            self._clock.sleep(min(timeout, 1.0))
+            return False
+        try:
+            fd=self.fileno()
+            if fd is not None:
+                r, w, x=select.select([fd], [], [], max(0, timeout))
+                return bool(r)
+
+            # no selectable fd (i.e. Windows COM port) : blocking read of
+            # one byte with the given timeout, kept for the next read()
+            self._serial.timeout=max(0, timeout)
+            try:
+                data=self._serial.read(1)
+            finally:
+                self._serial.timeout=0
+            if data:
+                self._pending=bytearray(data)
+                return True
+        except:
+            self.logger.exception('waitData(%s)', self._url)
+            self.close()
+        return False
 
     def read(self, size=255):
         try:
             if self.open() and size>0:
+                pending=self._pending
+                if pending:
+                    self._pending=None
+                    size-=len(pending)
+                    if size>0:
+                        data=self._serial.read(size)
+                        if data:
+                            pending.extend(data)
+                    return pending
                 data=self._serial.read(size)
                 if data:
                     return bytearray(data)
         except:
-            self.logger.exception('read(%s)' % self._url)
+            self.logger.exception('read(%s)', self._url)
             self.close()
 
     def write(self, data):
@@ -131,7 +211,165 @@ class LinkSerial(Link):
                 self._serial.write(data)
                 return True
         except:
-            self.logger.exception('write(%s)' % self._url)
+            self.logger.exception('write(%s)', self._url)
+            self.close()
+
+    def writeSome(self, data):
+        try:
+            if self.open():
+                fd=self.fileno()
+                if fd is None:
+                    return super(LinkSerial, self).writeSome(data)
+                # pyserial opens the port with O_NONBLOCK
+                try:
+                    return os.write(fd, data)
+                except BlockingIOError:
+                    return 0
+        except:
+            self.logger.exception('writeSome(%s)', self._url)
+            self.close()
+
+
+# in-memory link, created by pairs : what is written to one link is read
+# from the other one (simulation, tests, load testing)
+class LinkLoopback(Link):
+    def __init__(self, name, peer=None):
+        super(LinkLoopback, self).__init__(name)
+        self._inbuf=bytearray()
+        self._condition=Condition()
+        self._peer=None
+        if peer:
+            self.connect(peer)
+
+    @classmethod
+    def pair(cls, name1='loopback1', name2='loopback2'):
+        link=cls(name1)
+        return (link, cls(name2, link))
+
+    @property
+    def peer(self):
+        return self._peer
+
+    def connect(self, peer):
+        self._peer=peer
+        peer._peer=self
+
+    def feed(self, data):
+        # data received by this link
+        with self._condition:
+            self._inbuf.extend(data)
+            self._condition.notify_all()
+
+    def waitData(self, timeout):
+        with self._condition:
+            if not self._inbuf:
+                self._condition.wait(max(0, timeout))
+            return bool(self._inbuf)
+
+    def read(self, size=255):
+        with self._condition:
+            if self._inbuf and size>0:
+                data=self._inbuf[:size]
+                del self._inbuf[:size]
+                return data
+
+    def write(self, data):
+        if self._peer:
+            self._peer.feed(data)
+            return True
+
+
+# link backed by an OS pseudo-terminal (POSIX). The link uses the master side,
+# the peer (i.e. a control equipment simulator, or LinkSerial) opens the slave
+# device given by slaveName. The pty pair lives as long as the object : close()
+# (i.e. activity timeout) keeps it, so the peer is never left with a hung-up
+# slave, destroy() releases it
+class LinkPty(Link):
+    def __init__(self, name):
+        super(LinkPty, self).__init__(name)
+        self._master=None
+        self._slave=None
+        self.open()
+
+    @property
+    def slaveName(self):
+        if self._slave is not None:
+            return os.ttyname(self._slave)
+
+    def open(self):
+        if self._master is not None:
+            return True
+        import tty
+        (master, slave)=os.openpty()
+        tty.setraw(master)
+        tty.setraw(slave)
+        os.set_blocking(master, False)
+        self._master=master
+        self._slave=slave
+        if self.logger:
+            self.logger.info('pty(%s) opened', self.slaveName)
+        return True
+
+    def close(self):
+        # the pair is kept (see destroy())
+        pass
+
+    def destroy(self):
+        for fd in (self._master, self._slave):
+            try:
+                os.close(fd)
+            except:
+                pass
+        self._master=None
+        self._slave=None
+
+    def __del__(self):
+        self.destroy()
+
+    def fileno(self):
+        return self._master
+
+    def waitData(self, timeout):
+        if self.open():
+            (r, w, x)=select.select([self._master], [], [], max(0, timeout))
+            return bool(r)
+
+    def read(self, size=255):
+        try:
+            if self.open() and size>0:
+                data=os.read(self._master, size)
+                if data:
+                    return bytearray(data)
+        except BlockingIOError:
+            pass
+        except:
+            self.logger.exception('read()')
+            self.close()
+
+    def write(self, data):
+        try:
+            if self.open():
+                data=memoryview(data)
+                while data:
+                    try:
+                        size=os.write(self._master, data)
+                        data=data[size:]
+                    except BlockingIOError:
+                        select.select([], [self._master], [], 1.0)
+                return True
+        except:
+            self.logger.exception('write()')
+            self.close()
+
+    def writeSome(self, data):
+        try:
+            if self.open():
+                try:
+                    return os.write(self._master, data)
+                except BlockingIOError:
+                    return 0
+        except:
+            self.logger.exception('writeSome()')
             self.close()
 
 
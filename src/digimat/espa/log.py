@@ -0,0 +1,120 @@
+import os
+import time
+import queue
+import logging
+import logging.handlers
+
+from threading import Lock
+from collections import deque
+
+# Logging pipeline : the protocol threads only push log records into a bounded
+# in-memory queue (QueueHandler), a single background thread per log server
+# (QueueListener) formats them and sends them to the SocketHandler. A slow or
+# dead log server can't block the protocol, records are dropped instead.
+
+ESPA_LOG_QUEUE_SIZE = 10000
+ESPA_TRACE_SIZE = 1024
+
+_lock=Lock()
+_handlers={}
+
+
+class DropQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, queue):
+        super(DropQueueHandler, self).__init__(queue)
+        self.dropped=0
+
+    def prepare(self, record):
+        # records are formatted by the listener thread, not by the producer
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped+=1
+
+
+def logHandler(logServer, port=logging.handlers.DEFAULT_TCP_LOGGING_PORT):
+    # return the (shared) queue handler forwarding records to the log server
+    with _lock:
+        key=(logServer, port)
+        try:
+            return _handlers[key][0]
+        except KeyError:
+            pass
+        records=queue.Queue(ESPA_LOG_QUEUE_SIZE)
+        handler=DropQueueHandler(records)
+        listener=logging.handlers.QueueListener(records,
+            logging.handlers.SocketHandler(logServer, port),
+            respect_handler_level=True)
+        listener.start()
+        _handlers[key]=(handler, listener)
+        return handler
+
+
+def createLogger(name, logServer='localhost', logLevel=logging.INFO):
+    logger=logging.getLogger(name)
+    logger.setLevel(logLevel)
+    if logServer:
+        handler=logHandler(logServer)
+        if handler not in logger.handlers:
+            logger.addHandler(handler)
+    return logger
+
+
+def shutdown():
+    # flush and stop the listeners threads
+    with _lock:
+        for (handler, listener) in _handlers.values():
+            listener.stop()
+        _handlers.clear()
+
+
+def _afterFork():
+    # the listeners threads don't survive a fork (i.e. ShardedMultiChannelServer),
+    # the child process restarts its own ones with fresh queues and sockets
+    global _lock
+    _lock=Lock()
+    for (key, (handler, listener)) in list(_handlers.items()):
+        records=queue.Queue(ESPA_LOG_QUEUE_SIZE)
+        handler.queue=records
+        listener=logging.handlers.QueueListener(records,
+            logging.handlers.SocketHandler(*key),
+            respect_handler_level=True)
+        listener.start()
+        _handlers[key]=(handler, listener)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_afterFork)
+
+
+class WireTrace(object):
+    # bounded ring of the last raw RX/TX data of a channel, dumped on demand
+
+    def __init__(self, size=ESPA_TRACE_SIZE):
+        self._trace=deque(maxlen=size)
+
+    def record(self, direction, data):
+        self._trace.append((time.time(), direction, data))
+
+    def clear(self):
+        self._trace.clear()
+
+    def __len__(self):
+        return len(self._trace)
+
+    def entries(self):
+        return list(self._trace)
+
+    def dump(self):
+        lines=[]
+        for (stamp, direction, data) in list(self._trace):
+            lines.append('%s.%03d %s[%s]' % (time.strftime('%H:%M:%S', time.localtime(stamp)),
+                int(stamp*1000) % 1000, direction, ':'.join('%02X' % b for b in data)))
+        return lines
+
+
+if __name__=='__main__':
+    pass
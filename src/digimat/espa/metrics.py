@@ -0,0 +1,167 @@
+import bisect
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Cheap always-on metrics : every thread updates its own counters and
+# histograms (no lock on the hot path), they are aggregated when read. Gauges
+# (last value set) are shared.
+
+ESPA_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metrics(object):
+    def __init__(self, buckets=ESPA_LATENCY_BUCKETS):
+        self._buckets=tuple(buckets)
+        self._local=threading.local()
+        self._lock=threading.Lock()
+        self._shards=[]
+        self._gauges={}
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard=({}, {})
+            with self._lock:
+                self._shards.append(shard)
+            self._local.shard=shard
+            return shard
+
+    def inc(self, name, value=1, label=None):
+        # label : optional (name, value) pair
+        counters=self._shard()[0]
+        key=(name, label)
+        counters[key]=counters.get(key, 0)+value
+
+    def set(self, name, value, label=None):
+        # gauge
+        self._gauges[(name, label)]=value
+
+    def observe(self, name, value, label=None):
+        histograms=self._shard()[1]
+        key=(name, label)
+        histogram=histograms.get(key)
+        if histogram is None:
+            # one count per bucket (+Inf), then the sum of the observed values
+            histogram=[0]*(len(self._buckets)+1)+[0.0]
+            histograms[key]=histogram
+        histogram[bisect.bisect_left(self._buckets, value)]+=1
+        histogram[-1]+=value
+
+    def snapshot(self):
+        with self._lock:
+            shards=list(self._shards)
+
+        counters={}
+        histograms={}
+        for (shardCounters, shardHistograms) in shards:
+            for (key, value) in list(shardCounters.items()):
+                counters[key]=counters.get(key, 0)+value
+            for (key, values) in list(shardHistograms.items()):
+                histogram=histograms.get(key)
+                if histogram is None:
+                    histograms[key]=list(values)
+                else:
+                    for n in range(len(values)):
+                        histogram[n]+=values[n]
+
+        result={'counters': {}, 'gauges': {}, 'histograms': {}}
+        for ((name, label), value) in counters.items():
+            result['counters'].setdefault(name, {})[label]=value
+        for ((name, label), value) in list(self._gauges.items()):
+            result['gauges'].setdefault(name, {})[label]=value
+        for ((name, label), values) in histograms.items():
+            cumulative=0
+            buckets=[]
+            for n in range(len(self._buckets)):
+                cumulative+=values[n]
+                buckets.append((self._buckets[n], cumulative))
+            count=cumulative+values[len(self._buckets)]
+            result['histograms'].setdefault(name, {})[label]={'buckets': buckets,
+                'count': count, 'sum': values[-1]}
+        return result
+
+
+def _labels(channel, label, extra=None):
+    labels=['channel="%s"' % channel]
+    if label:
+        labels.append('%s="%s"' % label)
+    if extra:
+        labels.append(extra)
+    return '{%s}' % ','.join(labels)
+
+
+def toPrometheus(snapshots, prefix='espa'):
+    # snapshots : {channel: Metrics.snapshot()}, return the Prometheus text format
+    counters={}
+    gauges={}
+    histograms={}
+    for (channel, snapshot) in snapshots.items():
+        for (name, values) in snapshot['counters'].items():
+            for (label, value) in values.items():
+                counters.setdefault(name, []).append((channel, label, value))
+        for (name, values) in snapshot.get('gauges', {}).items():
+            for (label, value) in values.items():
+                gauges.setdefault(name, []).append((channel, label, value))
+        for (name, values) in snapshot['histograms'].items():
+            for (label, value) in values.items():
+                histograms.setdefault(name, []).append((channel, label, value))
+
+    lines=[]
+    for name in sorted(counters):
+        metric='%s_%s_total' % (prefix, name)
+        lines.append('# TYPE %s counter' % metric)
+        for (channel, label, value) in counters[name]:
+            lines.append('%s%s %s' % (metric, _labels(channel, label), value))
+    for name in sorted(gauges):
+        metric='%s_%s' % (prefix, name)
+        lines.append('# TYPE %s gauge' % metric)
+        for (channel, label, value) in gauges[name]:
+            lines.append('%s%s %s' % (metric, _labels(channel, label), value))
+    for name in sorted(histograms):
+        metric='%s_%s_seconds' % (prefix, name)
+        lines.append('# TYPE %s histogram' % metric)
+        for (channel, label, value) in histograms[name]:
+            for (le, count) in value['buckets']:
+                lines.append('%s_bucket%s %s' % (metric, _labels(channel, label, 'le="%g"' % le), count))
+            lines.append('%s_bucket%s %s' % (metric, _labels(channel, label, 'le="+Inf"'), value['count']))
+            lines.append('%s_sum%s %s' % (metric, _labels(channel, label), value['sum']))
+            lines.append('%s_count%s %s' % (metric, _labels(channel, label), value['count']))
+    return '\n'.join(lines)+'\n'
+
+
+class MetricsHTTPServer(object):
+    # minimal local HTTP endpoint serving source.metrics() in Prometheus format
+    def __init__(self, source, host='127.0.0.1', port=9464):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body=toPrometheus(source.metrics()).encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd=ThreadingHTTPServer((host, port), Handler)
+        self._httpd.daemon_threads=True
+        self._thread=threading.Thread(target=self._httpd.serve_forever)
+        self._thread.daemon=True
+
+    @property
+    def address(self):
+        return self._httpd.server_address
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+if __name__=='__main__':
+    pass
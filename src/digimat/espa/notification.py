@@ -1,13 +1,108 @@
+import time
+import struct
+
+# http://www.gscott.co.uk/ESPA.4.4.4/datablock.html
+
+# function codes (block header)
+ESPA_FUNCTION_CALL_TO_PAGER = '1'
+ESPA_FUNCTION_STATUS_INFORMATION = '2'
+ESPA_FUNCTION_STATUS_REQUEST = '3'
+ESPA_FUNCTION_CALL_SUBSCRIBER_LINE = '4'
+
+# data identifiers
+ESPA_DATA_CALL_ADDRESS = '1'
+ESPA_DATA_MESSAGE = '2'
+ESPA_DATA_BEEP_CODING = '3'
+ESPA_DATA_CALL_TYPE = '4'
+ESPA_DATA_TRANSMISSIONS = '5'
+ESPA_DATA_PRIORITY = '6'
+ESPA_DATA_CALL_STATUS = '7'
+ESPA_DATA_SYSTEM_STATUS = '8'
+
+# binary form (toBytes) : header, then the uint32 lengths and the utf8 bytes
+# of the strings name, source, (data identifier, value)*
+ESPA_NOTIFICATION_VERSION = 1
+ESPA_NOTIFICATION_HEADER = struct.Struct('<BBdqH')
+ESPA_NOTIFICATION_NO_SOURCE = 0x01
+
+
+class Field(object):
+    # typed attribute of a notification, converted from its data record (see
+    # schema) on first access and cached in the slot of the attribute. An
+    # invalid or missing record gives None
+    __slots__=('_did', '_attribute', '_kind')
+
+    def __init__(self, did):
+        self._did=did
+        self._attribute=None
+        self._kind=None
+
+    def __set_name__(self, owner, name):
+        (self._attribute, self._kind)=owner.schema[self._did]
+
+    def __get__(self, notification, owner=None):
+        if notification is None:
+            return self
+        try:
+            return getattr(notification, self._attribute)
+        except AttributeError:
+            pass
+        value=None
+        data=notification._data
+        if data:
+            record=data.get(self._did)
+            if record is not None:
+                try:
+                    value=self._kind(record)
+                except ValueError:
+                    pass
+        setattr(notification, self._attribute, value)
+        return value
+
 
 class Notification(object):
+    # function : ESPA function code of the decoded/encoded blocks (if any)
+    # schema : {data identifier: (attribute, type)}, the raw records are kept
+    # in data, the typed attributes (Field) are only converted when used
+    function=None
+    schema={}
+    __slots__=('_source', '_name', '_lname', '_data', '_timestamp', '_sequence')
+
     def __init__(self, source, name, data=None):
         self._source=source
         self._name=name
+        self._lname=name.lower() if name else name
         self._data=data
-        self.buildFromData(data)
+        self._timestamp=time.time()
+        self._sequence=None
+        if self.hasDataHook():
+            self.buildFromData(data)
+
+    @classmethod
+    def hasDataHook(cls):
+        # buildFromData() overriden by a subclass : called with the records
+        # of each new notification (the typed attributes are otherwise only
+        # converted when used)
+        return cls.buildFromData is not Notification.buildFromData
 
     def buildFromData(self, data):
-        pass
+        # replace the records, the typed attributes will be converted again
+        self._data=data
+        for (attribute, kind) in self.schema.values():
+            try:
+                delattr(self, attribute)
+            except AttributeError:
+                pass
+
+    @classmethod
+    def dataFromValues(cls, values):
+        # {attribute name: value} -> {data identifier: str}, None values ignored
+        data={}
+        for (did, (attribute, kind)) in cls.schema.items():
+            value=values.get(attribute.lstrip('_'))
+            if value is not None:
+                data[did]=str(value)
+        return data
 
     @property
     def source(self):
@@ -17,19 +112,31 @@ class Notification(object):
     def name(self):
         return self._name
 
+    @property
+    def timestamp(self):
+        return self._timestamp
+
+    @property
+    def sequence(self):
+        # journal sequence (None if not journaled)
+        return self._sequence
+
+    def setSequence(self, sequence):
+        self._sequence=sequence
+
     def isName(self, name):
-        if name and name.lower()==self.name.lower():
-            return True
+        # case insensitive (lowercased name computed once)
+        if name:
+            return name==self._name or name.lower()==self._lname
+        return False
 
     @property
     def data(self):
         return self._data
 
     def __getitem__(self, key):
-        try:
-            return self._data[key]
-        except:
-            pass
+        if self._data:
+            return self._data.get(key)
 
     def validate(self):
         return True
@@ -37,57 +144,159 @@ class Notification(object):
     def __repr__(self):
         return '%s:%s' % (self.source, self.name)
 
+    def toBytes(self):
+        # compact binary form (IPC, journal, spill), see fromBytes()
+        strings=[self._name, self._source or '']
+        data=self._data
+        if data:
+            for (did, value) in data.items():
+                strings.append(did)
+                strings.append(value)
+        strings=[string.encode('utf8') for string in strings]
+        flags=0
+        if self._source is None:
+            flags|=ESPA_NOTIFICATION_NO_SOURCE
+        sequence=self._sequence
+        if sequence is None:
+            sequence=-1
+        return b''.join([ESPA_NOTIFICATION_HEADER.pack(ESPA_NOTIFICATION_VERSION, flags,
+                self._timestamp, sequence, (len(strings)-2)//2),
+            struct.pack('<%dI' % len(strings), *[len(string) for string in strings])]+strings)
+
+    @staticmethod
+    def fromBytes(payload):
+        # notification of the class registered for its name (or Notification)
+        (version, flags, timestamp, sequence, records)=ESPA_NOTIFICATION_HEADER.unpack_from(payload)
+        if version!=ESPA_NOTIFICATION_VERSION:
+            raise ValueError('unsupported notification format [%d]' % version)
+        count=2+2*records
+        position=ESPA_NOTIFICATION_HEADER.size
+        lengths=struct.unpack_from('<%dI' % count, payload, position)
+        position+=4*count
+        strings=[]
+        for length in lengths:
+            strings.append(str(payload[position:position+length], 'utf8'))
+            position+=length
+
+        name=strings[0]
+        cls=notificationNamed(name) or Notification
+        notification=cls.__new__(cls)
+        notification._source=None if flags & ESPA_NOTIFICATION_NO_SOURCE else strings[1]
+        notification._name=name
+        notification._lname=name.lower()
+        notification._data=dict(zip(strings[2::2], strings[3::2])) if records else None
+        notification._timestamp=timestamp
+        notification._sequence=None if sequence<0 else sequence
+        if cls.hasDataHook():
+            notification.buildFromData(notification._data)
+        return notification
+
 
 class NotificationCallToPager(Notification):
+    function=ESPA_FUNCTION_CALL_TO_PAGER
+    schema={ESPA_DATA_CALL_ADDRESS: ('_callAddress', str),
+            ESPA_DATA_MESSAGE: ('_message', str),
+            ESPA_DATA_BEEP_CODING: ('_beepCoding', int),
+            ESPA_DATA_CALL_TYPE: ('_callType', int),
+            ESPA_DATA_TRANSMISSIONS: ('_transmissions', int),
+            ESPA_DATA_PRIORITY: ('_priority', int)}
+    __slots__=tuple(attribute for (attribute, kind) in schema.values())
+
+    callAddress=Field(ESPA_DATA_CALL_ADDRESS)
+    message=Field(ESPA_DATA_MESSAGE)
+    beepCoding=Field(ESPA_DATA_BEEP_CODING)
+    callType=Field(ESPA_DATA_CALL_TYPE)
+    transmissions=Field(ESPA_DATA_TRANSMISSIONS)
+    priority=Field(ESPA_DATA_PRIORITY)
+
     def __init__(self, source, data):
-        self._message=None
-        self._callAddress=None
-        self._beepCoding=None
-        self._callType=None
-        self._priority=None
         super(NotificationCallToPager, self).__init__(source, 'calltopager', data)
 
-    def buildFromData(self, data):
-        # http://www.gscott.co.uk/ESPA.4.4.4/datablock.html
-        try:
-            self._callAddress=data['1']
-        except:
-            pass
+    @classmethod
+    def create(cls, callAddress, message, beepCoding=None, callType=None, priority=None, source=None):
+        return cls(source, cls.dataFromValues({'callAddress': callAddress, 'message': message,
+            'beepCoding': beepCoding, 'callType': callType, 'priority': priority}))
 
-        try:
-            self._message=self.espaCharsetToUTF8(data['2'])
-        except:
-            pass
+    def espaCharsetToUTF8(self, message):
+        # the blocks are already decoded with the channel charset (see codec.py)
+        return message
 
-        try:
-            self._beepCoding=data['3']
-        except:
-            pass
+    def validate(self):
+        # on the raw records (the str fields need no conversion)
+        data=self._data
+        if data and data.get(ESPA_DATA_CALL_ADDRESS) and data.get(ESPA_DATA_MESSAGE):
+            return True
 
-        try:
-            self._callType=data['4']
-        except:
-            pass
+    def __repr__(self):
+        return '%s:%s(%s,%s)' % (self.source, self.name, self.callAddress, self.message)
 
-        try:
-            self._priority=data['6']
-        except:
-            pass
 
-    def espaCharsetToUTF8(self, message):
-        # todo
-        return message
+class NotificationStatusInformation(Notification):
+    function=ESPA_FUNCTION_STATUS_INFORMATION
+    schema={ESPA_DATA_CALL_ADDRESS: ('_callAddress', str),
+            ESPA_DATA_CALL_STATUS: ('_callStatus', int),
+            ESPA_DATA_SYSTEM_STATUS: ('_systemStatus', int)}
+    __slots__=tuple(attribute for (attribute, kind) in schema.values())
 
-    @property
-    def callAddress(self):
-        return self._callAddress
+    callAddress=Field(ESPA_DATA_CALL_ADDRESS)
+    callStatus=Field(ESPA_DATA_CALL_STATUS)
+    systemStatus=Field(ESPA_DATA_SYSTEM_STATUS)
 
-    @property
-    def message(self):
-        return self._message
+    def __init__(self, source, data):
+        super(NotificationStatusInformation, self).__init__(source, 'statusinformation', data)
+
+    @classmethod
+    def create(cls, callAddress=None, callStatus=None, systemStatus=None, source=None):
+        return cls(source, cls.dataFromValues({'callAddress': callAddress,
+            'callStatus': callStatus, 'systemStatus': systemStatus}))
+
+    def validate(self):
+        if self.callStatus is not None or self.systemStatus is not None:
+            return True
+
+    def __repr__(self):
+        return '%s:%s(%s,%s,%s)' % (self.source, self.name, self.callAddress, self.callStatus, self.systemStatus)
+
+
+class NotificationStatusRequest(Notification):
+    function=ESPA_FUNCTION_STATUS_REQUEST
+    schema={ESPA_DATA_CALL_ADDRESS: ('_callAddress', str),
+            ESPA_DATA_SYSTEM_STATUS: ('_systemStatus', int)}
+    __slots__=tuple(attribute for (attribute, kind) in schema.values())
+
+    callAddress=Field(ESPA_DATA_CALL_ADDRESS)
+    systemStatus=Field(ESPA_DATA_SYSTEM_STATUS)
+
+    def __init__(self, source, data):
+        super(NotificationStatusRequest, self).__init__(source, 'statusrequest', data)
+
+    @classmethod
+    def create(cls, callAddress=None, systemStatus=None, source=None):
+        return cls(source, cls.dataFromValues({'callAddress': callAddress, 'systemStatus': systemStatus}))
+
+
+class NotificationCallSubscriberLine(Notification):
+    function=ESPA_FUNCTION_CALL_SUBSCRIBER_LINE
+    schema={ESPA_DATA_CALL_ADDRESS: ('_callAddress', str),
+            ESPA_DATA_MESSAGE: ('_message', str),
+            ESPA_DATA_PRIORITY: ('_priority', int)}
+    __slots__=tuple(attribute for (attribute, kind) in schema.values())
+
+    callAddress=Field(ESPA_DATA_CALL_ADDRESS)
+    message=Field(ESPA_DATA_MESSAGE)
+    priority=Field(ESPA_DATA_PRIORITY)
+
+    def __init__(self, source, data):
+        super(NotificationCallSubscriberLine, self).__init__(source, 'callsubscriberline', data)
+
+    @classmethod
+    def create(cls, callAddress, message=None, priority=None, source=None):
+        return cls(source, cls.dataFromValues({'callAddress': callAddress,
+            'message': message, 'priority': priority}))
 
     def validate(self):
-        if self.callAddress and self.message:
+        data=self._data
+        if data and data.get(ESPA_DATA_CALL_ADDRESS):
             return True
 
     def __repr__(self):
@@ -95,9 +304,57 @@ class NotificationCallToPager(Notification):
 
 
 class NotificationLinkTimeout(Notification):
+    __slots__=()
+
     def __init__(self, source):
         super(NotificationLinkTimeout, self).__init__(source, 'linktimeout')
 
 
+# ESPA priority (data identifier 6) : 1 is the most urgent. Link and status
+# events rank above every call, a call without priority is 'normal'
+ESPA_PRIORITY_EVENT = 0
+ESPA_PRIORITY_NORMAL = 3
+
+
+def notificationPriority(notification):
+    # rank of the notification, the lower the more urgent
+    if isinstance(notification, (NotificationCallToPager, NotificationCallSubscriberLine)):
+        if notification.priority is not None:
+            return notification.priority
+        return ESPA_PRIORITY_NORMAL
+    return ESPA_PRIORITY_EVENT
+
+
+# function code -> Notification class of the decoded blocks
+_registry={}
+# name -> Notification class (fromBytes)
+_names={}
+
+
+def registerNotification(cls, name=None):
+    # cls must define function, schema and accept (source, data)
+    # name : name of its notifications, if not built from blocks
+    if cls.function is not None:
+        _registry[cls.function]=cls
+    if name is None:
+        name=cls(None, None).name
+    _names[name]=cls
+    return cls
+
+
+def notificationClass(function):
+    return _registry.get(function)
+
+
+def notificationNamed(name):
+    return _names.get(name)
+
+
+for cls in (NotificationCallToPager, NotificationStatusInformation,
+        NotificationStatusRequest, NotificationCallSubscriberLine):
+    registerNotification(cls)
+registerNotification(NotificationLinkTimeout, 'linktimeout')
+
+
 if __name__=='__main__':
     pass
@@ -0,0 +1,70 @@
+from collections import deque
+
+from .clock import ESPA_CLOCK
+from .notification import notificationPriority
+
+# Priority scheduling of the deliveries : one FIFO per ESPA priority level
+# (see notificationPriority(), the lower the more urgent), the most urgent
+# notification is delivered first. Anti-starvation aging : a notification
+# waiting for <aging> seconds is promoted by one level, so a routine call is
+# never delayed forever by a flow of urgent ones.
+#
+# Only the heads of the levels are compared (FIFO within a level), pop() is
+# O(number of levels). Not thread safe (used by the delivery loop).
+
+ESPA_PRIORITY_AGING = 5.0
+
+
+class NotificationPriorityQueue(object):
+    def __init__(self, aging=ESPA_PRIORITY_AGING, clock=None):
+        self._aging=aging
+        # time source of the aging (see clock.py)
+        self._clock=clock or ESPA_CLOCK
+        # level -> deque((push time, notification))
+        self._levels={}
+        self._count=0
+        self._promoted=0
+
+    def __len__(self):
+        return self._count
+
+    def stats(self):
+        return {'queued': self._count,
+                'levels': {level: len(queue) for (level, queue) in self._levels.items() if queue},
+                'promoted': self._promoted}
+
+    def push(self, notification, now=None):
+        if now is None:
+            now=self._clock.now()
+        level=notificationPriority(notification)
+        queue=self._levels.get(level)
+        if queue is None:
+            queue=self._levels[level]=deque()
+        queue.append((now, notification))
+        self._count+=1
+
+    def pop(self, now=None):
+        # most urgent notification (aging included), None if empty
+        if not self._count:
+            return None
+        if now is None:
+            now=self._clock.now()
+        best=None
+        for (level, queue) in self._levels.items():
+            if queue:
+                t=queue[0][0]
+                rank=level
+                if self._aging>0:
+                    rank-=(now-t)/self._aging
+                if best is None or rank<best[0] or (rank==best[0] and t<best[1]):
+                    best=(rank, t, level, queue)
+        (rank, t, level, queue)=best
+        if any(q for (l, q) in self._levels.items() if q and l<level):
+            # overtook a more urgent level thanks to its age
+            self._promoted+=1
+        self._count-=1
+        return queue.popleft()[1]
+
+
+if __name__=='__main__':
+    pass
@@ -0,0 +1,253 @@
+import os
+import json
+import bisect
+import logging
+
+from threading import Lock
+
+from .clock import ESPA_CLOCK
+
+# Routing table : the notifications are routed to targets (a callable, or a
+# name resolved by setTarget() or MultiChannelServer.onRoute()) by call
+# address, with optional source channel and notification name filters.
+#
+# Address matching, most specific first
+#  - exact address : dict
+#  - prefix : trie (one dict per character), the longest prefix first
+#  - range of numeric addresses : elementary intervals (bisect), the
+#    narrowest range first
+#  - no address : default routes
+# The first matching route (specificity, then registration order) wins. The
+# lookup is O(length of the address) + O(log(ranges)), whatever the number
+# of routes.
+#
+# The routes are compiled into an immutable index, swapped atomically when the
+# table changes. A table loaded from a JSON file is reloaded when the file is
+# modified (checked every checkPeriod seconds by the lookups)
+#
+#   {"routes": [
+#       {"address": "1234", "target": "icu"},
+#       {"prefix": "12", "source": "line1", "target": "ward-1"},
+#       {"range": [2000, 2999], "name": "calltopager", "target": "ward-2"},
+#       {"target": "default"}]}
+
+ESPA_ROUTING_CHECK_PERIOD = 1.0
+
+# trie node key of the routes ending at the node
+_ROUTES = ''
+
+
+class Route(object):
+    def __init__(self, target, address=None, prefix=None, range=None, source=None, name=None):
+        self._target=target
+        self._address=None if address is None else str(address)
+        self._prefix=None if prefix is None else str(prefix)
+        self._range=None
+        if range is not None:
+            (low, high)=(int(range[0]), int(range[1]))
+            if low>high:
+                raise ValueError('invalid range [%s]' % (range,))
+            self._range=(low, high)
+        self._source=source
+        self._name=name.lower() if name else None
+
+    @classmethod
+    def fromDict(cls, data):
+        return cls(data['target'], data.get('address'), data.get('prefix'), data.get('range'),
+            data.get('source'), data.get('name'))
+
+    @property
+    def target(self):
+        return self._target
+
+    @property
+    def address(self):
+        return self._address
+
+    @property
+    def prefix(self):
+        return self._prefix
+
+    @property
+    def range(self):
+        return self._range
+
+    def accepts(self, notification):
+        # source and name filters
+        if self._source is not None and self._source!=notification.source:
+            return False
+        if self._name is not None and self._name!=notification.name.lower():
+            return False
+        return True
+
+    def __repr__(self):
+        return 'route(%s->%s)' % (self._address or self._prefix or self._range or '*', self._target)
+
+
+class RoutingIndex(object):
+    # immutable compiled form of a list of routes
+    def __init__(self, routes):
+        self._exact={}
+        self._trie={}
+        self._default=[]
+        ranges=[]
+        for route in routes:
+            if route.address is not None:
+                self._exact.setdefault(route.address, []).append(route)
+            elif route.prefix is not None:
+                node=self._trie
+                for c in route.prefix:
+                    node=node.setdefault(c, {})
+                node.setdefault(_ROUTES, []).append(route)
+            elif route.range is not None:
+                ranges.append(route)
+            else:
+                self._default.append(route)
+        self.compileRanges(ranges)
+
+    def compileRanges(self, ranges):
+        # elementary intervals [bounds[n], bounds[n+1]) -> covering routes,
+        # the narrowest first (sweep over the range bounds)
+        order={route: n for (n, route) in enumerate(ranges)}
+        starts={}
+        ends={}
+        for route in ranges:
+            starts.setdefault(route.range[0], []).append(route)
+            ends.setdefault(route.range[1]+1, []).append(route)
+        self._bounds=sorted(set(starts) | set(ends))
+        self._segments=[]
+        active=[]
+        for bound in self._bounds:
+            for route in ends.get(bound, ()):
+                active.remove(route)
+            active.extend(starts.get(bound, ()))
+            self._segments.append(sorted(active, key=lambda route: (route.range[1]-route.range[0], order[route])))
+
+    def candidates(self, address):
+        # routes matching the address, the most specific first
+        if address is not None:
+            routes=self._exact.get(address)
+            if routes:
+                yield from routes
+            node=self._trie
+            prefixes=[node[_ROUTES]] if _ROUTES in node else []
+            for c in address:
+                node=node.get(c)
+                if node is None:
+                    break
+                routes=node.get(_ROUTES)
+                if routes:
+                    prefixes.append(routes)
+            for routes in reversed(prefixes):
+                yield from routes
+            if self._bounds and address.isdigit():
+                n=bisect.bisect_right(self._bounds, int(address))-1
+                if n>=0:
+                    yield from self._segments[n]
+        yield from self._default
+
+    def lookup(self, notification):
+        for route in self.candidates(getattr(notification, 'callAddress', None)):
+            if route.accepts(notification):
+                return route
+
+
+class RoutingTable(object):
+    def __init__(self, path=None, checkPeriod=ESPA_ROUTING_CHECK_PERIOD, logger=None, clock=None):
+        self._logger=logger or logging.getLogger('ESPA-ROUTING')
+        # time source of the file checks (see clock.py)
+        self._clock=clock or ESPA_CLOCK
+        self._lock=Lock()
+        # routes added by code, and loaded from the file
+        self._routes=[]
+        self._fileRoutes=[]
+        self._targets={}
+        self._index=RoutingIndex([])
+        self._path=path
+        self._checkPeriod=checkPeriod
+        self._checkTimeout=0
+        self._signature=None
+        if path:
+            self.reload(True)
+
+    @property
+    def logger(self):
+        return self._logger
+
+    def __len__(self):
+        return len(self._routes)+len(self._fileRoutes)
+
+    def setClock(self, clock):
+        self._clock=clock
+
+    def compile(self):
+        with self._lock:
+            index=RoutingIndex(self._routes+self._fileRoutes)
+            self._index=index
+        return index
+
+    def addRoute(self, target, address=None, prefix=None, range=None, source=None, name=None):
+        route=Route(target, address, prefix, range, source, name)
+        with self._lock:
+            self._routes.append(route)
+            # compiled by the next lookup
+            self._index=None
+        return route
+
+    def removeRoute(self, route):
+        with self._lock:
+            self._routes.remove(route)
+            self._index=None
+
+    def setTarget(self, name, handler):
+        # handler(notification) of the routes whose target is <name>
+        self._targets[name]=handler
+
+    def target(self, name):
+        return self._targets.get(name)
+
+    def load(self, path):
+        with open(path) as f:
+            data=json.load(f)
+        routes=[Route.fromDict(item) for item in data.get('routes', [])]
+        with self._lock:
+            self._fileRoutes=routes
+        self.compile()
+        self.logger.info('%d routes loaded from %s', len(routes), path)
+
+    def reload(self, force=False):
+        # reload the file if it has been modified, a bad file is ignored
+        # (the current routes are kept)
+        if not self._path:
+            return False
+        try:
+            st=os.stat(self._path)
+            signature=(st.st_mtime_ns, st.st_size)
+        except OSError:
+            signature=None
+        if signature is None or (signature==self._signature and not force):
+            return False
+        self._signature=signature
+        try:
+            self.load(self._path)
+            return True
+        except:
+            self.logger.exception('reload(%s)', self._path)
+            return False
+
+    def check(self):
+        if self._path and self._clock.now()>=self._checkTimeout:
+            self._checkTimeout=self._clock.now()+self._checkPeriod
+            self.reload()
+
+    def lookup(self, notification):
+        # matching route (None if none)
+        self.check()
+        index=self._index
+        if index is None:
+            index=self.compile()
+        return index.lookup(notification)
+
+
+if __name__=='__main__':
+    pass
@@ -0,0 +1,103 @@
+import time
+import heapq
+import itertools
+
+from threading import Lock
+
+# Monotonic deadline scheduler shared by the channels of an engine : every
+# channel (key) has at most one pending deadline, kept in a binary heap. The
+# engine sleeps exactly until the earliest deadline (or an I/O event) and only
+# processes the channels that are due, instead of polling all of them.
+#
+# A rescheduled or cancelled deadline is not removed from the heap, it is
+# skipped when it reaches the top (lazy deletion), so every operation is
+# O(log n). The heap is rebuilt when the stale entries outnumber the live ones.
+
+
+class DeadlineScheduler(object):
+    def __init__(self, clock=time.monotonic):
+        self._clock=clock
+        self._heap=[]
+        self._deadlines={}
+        self._counter=itertools.count()
+        self._lock=Lock()
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def now(self):
+        return self._clock()
+
+    def deadline(self, key):
+        return self._deadlines.get(key)
+
+    def schedule(self, key, deadline):
+        # set (or replace) the deadline of key, None cancels it
+        with self._lock:
+            if deadline is None:
+                self._deadlines.pop(key, None)
+                return
+            if self._deadlines.get(key)==deadline:
+                return
+            self._deadlines[key]=deadline
+            heapq.heappush(self._heap, (deadline, next(self._counter), key))
+            if len(self._heap)>2*len(self._deadlines)+64:
+                self._rebuild()
+
+    def scheduleIn(self, key, delay):
+        if delay is None:
+            self.schedule(key, None)
+        else:
+            self.schedule(key, self._clock()+max(0, delay))
+
+    def cancel(self, key):
+        self.schedule(key, None)
+
+    def _rebuild(self):
+        self._heap=[(deadline, next(self._counter), key) for (key, deadline) in self._deadlines.items()]
+        heapq.heapify(self._heap)
+
+    def _top(self):
+        # earliest live entry, stale ones are dropped
+        heap=self._heap
+        while heap:
+            (deadline, count, key)=heap[0]
+            if self._deadlines.get(key)==deadline:
+                return heap[0]
+            heapq.heappop(heap)
+
+    def next(self):
+        # earliest deadline (None if nothing is scheduled)
+        with self._lock:
+            top=self._top()
+            if top:
+                return top[0]
+
+    def delay(self, maxDelay=None):
+        # time until the earliest deadline, bounded by maxDelay
+        deadline=self.next()
+        if deadline is None:
+            return maxDelay
+        delay=max(0, deadline-self._clock())
+        if maxDelay is not None:
+            delay=min(delay, maxDelay)
+        return delay
+
+    def due(self, now=None):
+        # pop and return the keys whose deadline is reached
+        if now is None:
+            now=self._clock()
+        keys=[]
+        with self._lock:
+            while True:
+                top=self._top()
+                if not top or top[0]>now:
+                    break
+                heapq.heappop(self._heap)
+                del self._deadlines[top[2]]
+                keys.append(top[2])
+        return keys
+
+
+if __name__=='__main__':
+    pass
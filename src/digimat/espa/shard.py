@@ -0,0 +1,275 @@
+import os
+import time
+import signal
+import logging
+import multiprocessing
+
+from multiprocessing.connection import wait
+
+from .bus import NotificationBus
+from .notification import Notification
+from .espa import MultiChannelServer, ESPA_MANAGER_MAX_WAIT
+
+# Multi-process MultiChannelServer : the servers are spread over a pool of
+# worker processes (shards), each one running the state machines of its own
+# channels with its own interpreter (and GIL). The shards are forked from the
+# parent, inheriting the (not yet started) servers and links, and send the
+# notifications back in batches over a pipe. A channel always lives in the same
+# shard and a pipe is FIFO, so the per channel ordering is preserved.
+#
+# The parent supervises the shards : a dead shard is forked again (from the
+# pristine servers of the parent) after ESPA_SHARD_RESTART_DELAY.
+
+ESPA_SHARD_RESTART_DELAY = 1.0
+
+# period of the metrics snapshots sent by the shards
+ESPA_SHARD_METRICS_PERIOD = 1.0
+
+# pipe messages
+ESPA_SHARD_NOTIFICATIONS = 'n'    # [Notification.toBytes()]
+ESPA_SHARD_METRICS = 'm'
+ESPA_SHARD_STOP = 's'
+
+
+def _shardMain(servers, conn):
+    # shard (child process) main loop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    parent=os.getppid()
+    bus=NotificationBus()
+    for server in servers:
+        server.setNotificationBus(bus)
+        server.start()
+
+    def sendMetrics():
+        conn.send((ESPA_SHARD_METRICS, {server.name: server.metrics.snapshot() for server in servers}))
+
+    metricsTimeout=0
+    try:
+        while os.getppid()==parent:
+            notifications=bus.drain(timeout=ESPA_MANAGER_MAX_WAIT)
+            if notifications:
+                conn.send((ESPA_SHARD_NOTIFICATIONS, [notification.toBytes() for notification in notifications]))
+            if time.monotonic()>=metricsTimeout:
+                metricsTimeout=time.monotonic()+ESPA_SHARD_METRICS_PERIOD
+                sendMetrics()
+            if conn.poll() and conn.recv()[0]==ESPA_SHARD_STOP:
+                break
+    except (EOFError, OSError):
+        # parent gone
+        pass
+
+    for server in servers:
+        server.stop()
+    for server in servers:
+        server.waitForExit()
+    try:
+        notifications=bus.drain(timeout=0)
+        if notifications:
+            conn.send((ESPA_SHARD_NOTIFICATIONS, [notification.toBytes() for notification in notifications]))
+        sendMetrics()
+        conn.close()
+    except:
+        pass
+
+
+class Shard(object):
+    def __init__(self, index, servers, context):
+        self._index=index
+        self._servers=servers
+        self._context=context
+        self._process=None
+        self._conn=None
+        self._restartTimeout=0
+        self._restarts=0
+
+    @property
+    def index(self):
+        return self._index
+
+    @property
+    def restarts(self):
+        return self._restarts
+
+    @property
+    def conn(self):
+        return self._conn
+
+    @property
+    def sentinel(self):
+        return self._process.sentinel
+
+    def servers(self):
+        return list(self._servers)
+
+    def start(self):
+        (conn, child)=self._context.Pipe()
+        process=self._context.Process(target=_shardMain, args=(self._servers, child),
+            name='espa-shard-%d' % self._index)
+        process.daemon=True
+        process.start()
+        child.close()
+        if self._process is not None:
+            self._restarts+=1
+        self._process=process
+        self._conn=conn
+        self._restartTimeout=time.monotonic()+ESPA_SHARD_RESTART_DELAY
+
+    def isAlive(self):
+        return self._process is not None and self._process.is_alive()
+
+    def restartDelay(self):
+        return max(0, self._restartTimeout-time.monotonic())
+
+    def closeConn(self):
+        if self._conn:
+            try:
+                self._conn.close()
+            except:
+                pass
+            self._conn=None
+
+    def stop(self):
+        try:
+            self._conn.send((ESPA_SHARD_STOP, None))
+        except:
+            pass
+
+    def join(self, timeout=None):
+        if self._process is not None:
+            self._process.join(timeout)
+            if self._process.is_alive():
+                self._process.terminate()
+                self._process.join()
+
+
+class ShardedMultiChannelServer(MultiChannelServer):
+    def __init__(self, processes=None, workers=0, **kwargs):
+        if kwargs.get('journal'):
+            # the notifications must be journaled before the ACK, by the shards
+            raise ValueError('journal not supported by the sharded server')
+        super(ShardedMultiChannelServer, self).__init__(workers, **kwargs)
+        # the servers (threads, locks, open links) can't be pickled : the
+        # shards must inherit them with fork()
+        self._context=multiprocessing.get_context('fork')
+        self._processes=processes or os.cpu_count() or 1
+        self._shards=[]
+        self._shardMetrics={}
+        self._stop=False
+        self._logger=logging.getLogger('ESPA-SHARDS')
+
+    @property
+    def logger(self):
+        return self._logger
+
+    def shards(self):
+        return list(self._shards)
+
+    def shardOf(self, name):
+        for shard in self._shards:
+            for server in shard.servers():
+                if server.name==name:
+                    return shard
+
+    def startServers(self):
+        if self._servers:
+            self._stop=False
+            servers=sorted(self.servers(), key=lambda server: server.name)
+            count=min(self._processes, len(servers))
+            self._shards=[Shard(n, servers[n::count], self._context) for n in range(count)]
+            for shard in self._shards:
+                shard.start()
+                self.logger.info('shard %d started (%d channels)', shard.index, len(shard.servers()))
+            return True
+
+    def isRunning(self):
+        return not self._stop
+
+    def stopServers(self, wait=True):
+        self._stop=True
+        for shard in self._shards:
+            shard.stop()
+        if wait:
+            for shard in self._shards:
+                shard.join(ESPA_MANAGER_MAX_WAIT*3)
+
+    def metrics(self):
+        # snapshots received from the shards, completed with the metrics
+        # collected by the parent (queue_wait)
+        result={}
+        for server in self.servers():
+            snapshot=self._shardMetrics.get(server.name)
+            if snapshot is None:
+                snapshot={'counters': {}, 'gauges': {}, 'histograms': {}}
+            local=server.metrics.snapshot()
+            result[server.name]={'counters': dict(snapshot['counters'], **local['counters']),
+                'gauges': dict(snapshot['gauges'], **local['gauges']),
+                'histograms': dict(snapshot['histograms'], **local['histograms'])}
+        return result
+
+    def receive(self, shard):
+        try:
+            (kind, data)=shard.conn.recv()
+        except (EOFError, OSError):
+            shard.closeConn()
+            return
+
+        if kind==ESPA_SHARD_NOTIFICATIONS:
+            data=[Notification.fromBytes(payload) for payload in data]
+            if self._priorityQueue is not None:
+                # by priority within the received batch
+                for notification in data:
+                    self._priorityQueue.push(notification)
+                while self._priorityQueue:
+                    self.dispatch(self._priorityQueue.pop())
+            else:
+                for notification in data:
+                    self.dispatch(notification)
+        elif kind==ESPA_SHARD_METRICS:
+            self._shardMetrics.update(data)
+
+    def supervise(self):
+        # restart the dead shards, return the delay before the next restart
+        timeout=ESPA_MANAGER_MAX_WAIT
+        for shard in self._shards:
+            if not shard.isAlive() and not shard.conn:
+                delay=shard.restartDelay()
+                if delay>0:
+                    timeout=min(timeout, delay)
+                    continue
+                self.logger.error('shard %d died, restarting it', shard.index)
+                shard.join()
+                shard.start()
+        return timeout
+
+    def run(self):
+        if self.startServers():
+            while not self._stop:
+                try:
+                    timeout=self.supervise()
+                    conns={shard.conn: shard for shard in self._shards if shard.conn}
+                    for conn in wait(list(conns.keys()), timeout):
+                        self.receive(conns[conn])
+                except:
+                    self.logger.exception('run()')
+                    self._stop=True
+
+            self.stopServers(False)
+            # remaining notifications, until every shard has closed its pipe
+            timeout=time.monotonic()+ESPA_MANAGER_MAX_WAIT*3
+            while time.monotonic()<timeout:
+                conns={shard.conn: shard for shard in self._shards if shard.conn}
+                if not conns:
+                    break
+                for conn in wait(list(conns.keys()), max(0, timeout-time.monotonic())):
+                    self.receive(conns[conn])
+            self.stopServers()
+            for shard in self._shards:
+                shard.closeConn()
+
+            if self._dispatcher:
+                self._dispatcher.shutdown()
+            self._invoker.close()
+
+
+if __name__=='__main__':
+    pass
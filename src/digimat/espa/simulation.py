@@ -0,0 +1,234 @@
+import random
+import logging
+
+from .clock import VirtualClock
+from .link import Link
+from .espa import Server, ESPA_CLIENT_ACTIVITY_TIMEOUT
+from .frame import encode_frame
+from .frame import ESPA_CHAR_ENQ, ESPA_CHAR_ACK, ESPA_CHAR_NAK, ESPA_CHAR_EOT
+from .notification import NotificationCallToPager, NotificationLinkTimeout
+
+# Deterministic simulation : a Server state machine is stepped under virtual
+# time (VirtualClock) with scripted link input, so that the timeout and
+# recovery paths (60s session, 15s message, 2.5s ENQ sequence, 120s activity)
+# are exercised in microseconds. fuzz() runs random fault injection scenarios
+# (line noise, truncated blocks, bad BCC, stalled or silent peer) and checks
+# that the server always recovers and never publishes a corrupted call.
+#
+#   sim=Simulation()
+#   sim.feed(sim.enquiry())
+#   sim.advance(1.0)
+#   sim.output() -> b'\x06'
+
+# virtual time step when the server has an immediate deadline
+ESPA_SIMULATION_QUANTUM = 0.001
+
+# quiet time after which any session has been reset (longest session timeout)
+ESPA_SIMULATION_RECOVERY = 61.0
+
+
+class LinkSimulated(Link):
+    # scripted link : the input is fed by the simulation, the output recorded
+    def __init__(self, name='sim'):
+        super(LinkSimulated, self).__init__(name)
+        self._input=bytearray()
+        self._output=bytearray()
+
+    def open(self):
+        return True
+
+    def feed(self, data):
+        self._input.extend(data)
+
+    def pending(self):
+        return len(self._input)
+
+    def waitData(self, timeout):
+        if not self._input:
+            self._clock.sleep(timeout)
+        return bool(self._input)
+
+    def read(self, size=255):
+        if self._input and size>0:
+            data=self._input[:size]
+            del self._input[:size]
+            return data
+
+    def write(self, data):
+        self._output.extend(data)
+        return True
+
+    def output(self):
+        data=bytes(self._output)
+        self._output.clear()
+        return data
+
+
+class Simulation(object):
+    def __init__(self, name='sim', seed=None, logLevel=logging.CRITICAL, **kwargs):
+        self._clock=VirtualClock()
+        self._link=LinkSimulated(name)
+        self._server=Server(self._link, logServer=None, logLevel=logLevel, clock=self._clock, **kwargs)
+        self._server.channel.open()
+        self._random=random.Random(seed)
+        self._notifications=[]
+
+    @property
+    def clock(self):
+        return self._clock
+
+    @property
+    def link(self):
+        return self._link
+
+    @property
+    def server(self):
+        return self._server
+
+    @property
+    def random(self):
+        return self._random
+
+    def now(self):
+        return self._clock.now()
+
+    def feed(self, data):
+        self._link.feed(data)
+
+    def step(self):
+        self._server.process()
+        while True:
+            notification=self._server.getNotification(0)
+            if notification is None:
+                break
+            self._notifications.append(notification)
+
+    def advance(self, delay):
+        # run the server for delay seconds of virtual time, jumping from
+        # deadline to deadline
+        end=self._clock.now()+delay
+        self.step()
+        while True:
+            deadline=self._clock.now()+max(self._server.nextTimeout(), ESPA_SIMULATION_QUANTUM)
+            if deadline>end:
+                self._clock.advanceTo(end)
+                self.step()
+                return
+            self._clock.advanceTo(deadline)
+            self.step()
+
+    def output(self):
+        return self._link.output()
+
+    def notifications(self):
+        notifications=self._notifications
+        self._notifications=[]
+        return notifications
+
+    def enquiry(self):
+        # control equipment selection sequence '1' ENQ '2' ENQ
+        return ('1%s2%s' % (ESPA_CHAR_ENQ, ESPA_CHAR_ENQ)).encode('ascii')
+
+    def call(self, callAddress, message, **kwargs):
+        # complete frame of a call to pager
+        notification=NotificationCallToPager.create(callAddress, message, **kwargs)
+        return encode_frame(notification.function, notification.data, self._server.channel.charset)
+
+    def transaction(self, callAddress, message, **kwargs):
+        return self.enquiry()+self.call(callAddress, message, **kwargs)
+
+    # --------------------------------------
+    # faults
+
+    def noise(self, size=None):
+        if size is None:
+            size=self._random.randint(1, 64)
+        return bytes(self._random.getrandbits(8) for n in range(size))
+
+    def truncate(self, frame):
+        return frame[:self._random.randint(1, len(frame)-1)]
+
+    def badBcc(self, frame):
+        return frame[:-1]+bytes((frame[-1] ^ self._random.randint(1, 255),))
+
+    def corrupt(self, frame):
+        # one bit flipped in the block (between SOH and ETX)
+        data=bytearray(frame)
+        n=self._random.randint(1, len(data)-3)
+        data[n]^=1 << self._random.randint(0, 6)
+        return bytes(data)
+
+
+ESPA_SIMULATION_FAULTS = ('noise', 'truncate', 'badbcc', 'corrupt', 'stall', 'split', 'silence')
+
+
+def fuzz(count=1000, seed=0, faults=ESPA_SIMULATION_FAULTS):
+    # run <count> random fault scenarios on a single simulated server, each
+    # one followed by a clean transaction that must be acknowledged and
+    # delivered exactly once. Return the statistics, raise AssertionError
+    # on the first violated invariant.
+    sim=Simulation(seed=seed)
+    rng=sim.random
+    stats={'scenarios': 0, 'delivered': 0, 'virtual_time': 0.0}
+    for fault in faults:
+        stats[fault]=0
+
+    for n in range(count):
+        fault=rng.choice(faults)
+        stats[fault]+=1
+        callAddress=str(rng.randint(1, 9999))
+        frame=sim.call(callAddress, 'scenario %d' % n)
+
+        if fault=='noise':
+            sim.feed(sim.noise())
+        elif fault=='truncate':
+            sim.feed(sim.enquiry()+sim.truncate(frame))
+        elif fault=='badbcc':
+            sim.feed(sim.enquiry()+sim.badBcc(frame))
+        elif fault=='corrupt':
+            sim.feed(sim.enquiry()+sim.corrupt(frame))
+        elif fault=='stall':
+            # peer stalled in the middle of the selection sequence
+            sim.feed(sim.enquiry()[:rng.randint(1, 3)])
+        elif fault=='split':
+            # valid transaction, byte by byte (the whole block within the
+            # 3s message timeout)
+            for b in sim.transaction(callAddress, 'scenario %d' % n):
+                sim.feed(bytes((b,)))
+                sim.advance(rng.uniform(0, 0.05))
+            sim.advance(0.1)
+            notifications=sim.notifications()
+            assert [x.callAddress for x in notifications]==[callAddress], (n, fault, notifications)
+            stats['delivered']+=1
+        elif fault=='silence':
+            # no activity at all : the link must be declared dead
+            sim.advance(ESPA_CLIENT_ACTIVITY_TIMEOUT+1)
+            notifications=sim.notifications()
+            assert [x for x in notifications if isinstance(x, NotificationLinkTimeout)], (n, fault, notifications)
+
+        # let the server recover, then a clean transaction must succeed
+        sim.advance(ESPA_SIMULATION_RECOVERY)
+        notifications=sim.notifications()
+        if fault!='corrupt':
+            # a bit flipped on a framing character may move the ETX, the
+            # shorter block then has a 1/256 chance to match its BCC
+            assert not [x for x in notifications if isinstance(x, NotificationCallToPager)], (n, fault, notifications)
+        sim.output()
+
+        callAddress=str(rng.randint(1, 9999))
+        sim.feed(sim.transaction(callAddress, 'check %d' % n))
+        sim.advance(0.1)
+        output=sim.output()
+        assert output.endswith((ESPA_CHAR_ACK+ESPA_CHAR_EOT).encode('ascii')), (n, fault, output)
+        assert ESPA_CHAR_NAK.encode('ascii') not in output, (n, fault, output)
+        notifications=[x for x in sim.notifications() if isinstance(x, NotificationCallToPager)]
+        assert [x.callAddress for x in notifications]==[callAddress], (n, fault, notifications)
+        stats['delivered']+=1
+        stats['scenarios']+=1
+
+    stats['virtual_time']=sim.now()
+    return stats
+
+
+if __name__=='__main__':
+    pass
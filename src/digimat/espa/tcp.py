@@ -0,0 +1,333 @@
+import errno
+import select
+import socket
+import logging
+import selectors
+
+from threading import Thread
+from threading import Event
+
+from .link import Link
+from .scheduler import DeadlineScheduler
+from .codec import ESPA_CHARSET_DEFAULT
+from .espa import Server, MultiChannelServer, ESPA_MANAGER_MAX_WAIT
+
+# ESPA over TCP (i.e. serial-to-ethernet converters). Many TCP sessions are
+# multiplexed by a single selectors loop, each connection being managed by
+# a regular Server state machine (see TCPMultiChannelServer). The loop sleeps
+# until the next I/O event or protocol deadline (DeadlineScheduler) and only
+# runs the servers that are ready or due.
+
+ESPA_TCP_REOPEN_DELAY = 15
+
+
+class LinkTCP(Link):
+    def __init__(self, name, host=None, port=None, sock=None):
+        super(LinkTCP, self).__init__(name)
+        self._host=host
+        self._port=port
+        self._socket=None
+        self._reopenTimeout=0
+        # accepted (inbound) connection : can't be reopened
+        self._inbound=sock is not None
+        if sock is not None:
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._socket=sock
+
+    @property
+    def address(self):
+        return '%s:%s' % (self._host, self._port)
+
+    def isInbound(self):
+        return self._inbound
+
+    def isClosed(self):
+        return self._socket is None
+
+    def open(self):
+        if self._socket:
+            return True
+        if self._inbound:
+            return False
+        try:
+            if self._clock.now()>=self._reopenTimeout:
+                self._reopenTimeout=self._clock.now()+ESPA_TCP_REOPEN_DELAY
+                self.logger.info('connect(%s)', self.address)
+                if self._metrics:
+                    self._metrics.inc('reopen_attempts')
+                # non blocking connect, errors are reported by the next read()
+                s=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                s.setblocking(False)
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                e=s.connect_ex((self._host, self._port))
+                if e not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    s.close()
+                    raise OSError(e, 'connect(%s)' % self.address)
+                self._socket=s
+                return True
+        except:
+            self.logger.exception('open()')
+            self._socket=None
+
+    def close(self):
+        if self._socket:
+            try:
+                self.logger.info('close(%s)', self.address)
+                self._socket.close()
+            except:
+                pass
+        self._socket=None
+
+    def fileno(self):
+        try:
+            return self._socket.fileno()
+        except:
+            pass
+
+    def waitData(self, timeout):
+        if not self.open():
+            self._clock.sleep(min(timeout, 1.0))
+            return False
+        (r, w, x)=select.select([self._socket], [], [], max(0, timeout))
+        return bool(r)
+
+    def read(self, size=255):
+        try:
+            if self.open() and size>0:
+                data=self._socket.recv(size)
+                if data:
+                    return bytearray(data)
+                self.logger.warning('connection closed by peer (%s)', self.address)
+                self.close()
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as e:
+            if e.errno==errno.ENOTCONN:
+                # connection in progress
+                return
+            self.logger.error('read(%s) %s', self.address, e)
+            self.close()
+
+    def write(self, data):
+        try:
+            if self.open():
+                self._socket.sendall(data)
+                return True
+        except:
+            self.logger.exception('write(%s)', self.address)
+            self.close()
+
+    def writeSome(self, data):
+        try:
+            if self.open():
+                try:
+                    return self._socket.send(data)
+                except (BlockingIOError, InterruptedError):
+                    return 0
+        except OSError as e:
+            if e.errno==errno.ENOTCONN:
+                # connection in progress
+                return 0
+            self.logger.error('write(%s) %s', self.address, e)
+            self.close()
+
+
+class LinkTCPServer(object):
+    def __init__(self, host='0.0.0.0', port=4000, names=None, backlog=64):
+        # names : optional {peer ip: channel name} map
+        self._host=host
+        self._port=port
+        self._names=names or {}
+        self._socket=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((host, port))
+        self._socket.listen(backlog)
+        self._socket.setblocking(False)
+
+    @property
+    def address(self):
+        return self._socket.getsockname()
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def channelName(self, peer):
+        try:
+            return self._names[peer[0]]
+        except KeyError:
+            return 'tcp:%s:%d' % peer[:2]
+
+    def accept(self):
+        # return the LinkTCP of every pending inbound connection
+        links=[]
+        while True:
+            try:
+                (sock, peer)=self._socket.accept()
+            except (BlockingIOError, InterruptedError):
+                break
+            links.append(LinkTCP(self.channelName(peer), peer[0], peer[1], sock))
+        return links
+
+    def close(self):
+        try:
+            self._socket.close()
+        except:
+            pass
+
+
+class TCPMultiChannelServer(MultiChannelServer):
+    def __init__(self, workers=0, logServer='localhost', logLevel=logging.INFO, charset=ESPA_CHARSET_DEFAULT, clock=None, **kwargs):
+        super(TCPMultiChannelServer, self).__init__(workers, clock=clock, **kwargs)
+        self._logServer=logServer
+        self._logLevel=logLevel
+        self._charset=charset
+        # self._clock (MultiChannelServer) : also the time source of the
+        # servers and of their deadlines
+        self._listeners=[]
+        self._selector=None
+        self._registered={}
+        self._scheduler=DeadlineScheduler(self._clock.now)
+        self._eventStop=Event()
+        self._thread=None
+        self._logger=logging.getLogger('ESPA-TCP')
+
+    @property
+    def logger(self):
+        return self._logger
+
+    def listen(self, host='0.0.0.0', port=4000, names=None):
+        listener=LinkTCPServer(host, port, names)
+        self._listeners.append(listener)
+        return listener
+
+    def connect(self, name, host, port):
+        server=Server(LinkTCP(name, host, port), logServer=self._logServer, logLevel=self._logLevel, charset=self._charset, clock=self._clock)
+        self.add(server)
+        return server
+
+    def add(self, server):
+        super(TCPMultiChannelServer, self).add(server)
+        if server and isinstance(server, Server):
+            # the servers share the selector loop : a full bus must refuse
+            # (NAK) the notifications immediately, never block the loop
+            server.setPublishTimeout(0)
+
+    def createServer(self, link):
+        # inbound connection, may be overriden
+        return Server(link, logServer=self._logServer, logLevel=self._logLevel, charset=self._charset, clock=self._clock)
+
+    def _accept(self, listener):
+        for link in listener.accept():
+            self.logger.info('inbound connection %s', link.name)
+            server=self._servers.get(link.name)
+            if server:
+                self._remove(server)
+            server=self.createServer(link)
+            # the first enquiry of the peer may already be on the socket, and
+            # an idle inbound connection is not a dead link (closed by the peer)
+            server.setFlush(False)
+            server.channel.setActivityTimeout(0)
+            server.channel.open()
+            self.add(server)
+            self._scheduler.scheduleIn(server, 0)
+
+    def _remove(self, server):
+        self._unregister(server)
+        self._scheduler.cancel(server)
+        server.stop()
+        server.channel.close()
+        try:
+            del self._servers[server.name]
+        except KeyError:
+            pass
+
+    def _unregister(self, server):
+        fd=self._registered.pop(server, None)
+        if fd is not None:
+            try:
+                self._selector.unregister(fd)
+            except:
+                pass
+
+    def _register(self, server):
+        # follow the link file descriptor (reconnections)
+        fd=server.channel.fileno()
+        if self._registered.get(server)!=fd:
+            self._unregister(server)
+            if fd is not None:
+                try:
+                    self._selector.register(fd, selectors.EVENT_READ, server)
+                except KeyError:
+                    # fd reused by the system, previous owner has been closed
+                    self._registered.pop(self._selector.get_key(fd).data, None)
+                    self._selector.modify(fd, selectors.EVENT_READ, server)
+                self._registered[server]=fd
+
+    def _step(self, server):
+        # run the server state machine and schedule its next deadline
+        server.process()
+        link=server.channel.link
+        if isinstance(link, LinkTCP) and link.isInbound() and link.isClosed():
+            self.logger.info('connection %s closed', server.name)
+            self._remove(server)
+            return
+        self._register(server)
+        delay=server.nextTimeout()
+        if server not in self._registered:
+            # not connected : polled (reconnection)
+            delay=min(delay, ESPA_MANAGER_MAX_WAIT)
+        self._scheduler.scheduleIn(server, delay)
+
+    def _manager(self):
+        self._selector=selectors.DefaultSelector()
+        for listener in self._listeners:
+            self._selector.register(listener.fileno(), selectors.EVENT_READ, listener)
+        for server in self.servers():
+            server.channel.open()
+            self._scheduler.scheduleIn(server, 0)
+
+        while not self._eventStop.isSet():
+            try:
+                ready=[]
+                for (key, events) in self._selector.select(self._scheduler.delay(ESPA_MANAGER_MAX_WAIT)):
+                    if isinstance(key.data, LinkTCPServer):
+                        self._accept(key.data)
+                    else:
+                        ready.append(key.data)
+
+                for server in ready:
+                    self._step(server)
+                for server in self._scheduler.due():
+                    self._step(server)
+            except:
+                self.logger.exception('manager()')
+                self._eventStop.set()
+
+        for server in self.servers():
+            self._unregister(server)
+            self._scheduler.cancel(server)
+            server.channel.close()
+        for listener in self._listeners:
+            listener.close()
+        self._selector.close()
+
+    def startServers(self):
+        if self._servers or self._listeners:
+            self._eventStop.clear()
+            self._thread=Thread(target=self._manager)
+            self._thread.daemon=True
+            self._thread.start()
+            return True
+
+    def isRunning(self):
+        return not self._eventStop.isSet()
+
+    def stopServers(self, wait=True):
+        self._eventStop.set()
+        if wait and self._thread:
+            self._thread.join()
+
+
+if __name__=='__main__':
+    pass